@@ -16,11 +16,134 @@ def main():
                'it does not start with /')
     config.set('GLOBAL', 'PlotImgDir', './specweb/static/plots')
 
+    config['WAVEFORM'] = {
+        '; Where to pull waveform data from. One of:': None,
+        ';   winston - a winston wave server, see the WINSTON section': None,
+        ';   sds - a local SDS miniSEED archive, see the SDS section': None,
+        'Source': 'winston',
+    }
+
     config['WINSTON'] = {
-        '; Currently waveform data is pulled from a winston.': None,
-        '; In the future, this may become configurable to any ObsPy data source': None,
         'url': 'pubavo1.wr.usgs.gov',
         'port': 16022,
+        '; Number of connections to keep open to the winston for bulk requests': None,
+        'PoolSize': 8,
+        'Timeout': 30,
+    }
+
+    config['SDS'] = {
+        '; Root directory of a local SDS (SeisComP Data Structure) archive': None,
+        'Root': '/data/sds',
+    }
+
+    config['SCHEDULER'] = {
+        '; Fraction of MinutesPerImage a run may take. The current window is always': None,
+        '; generated first; retries of missed windows get whatever time is left,': None,
+        '; and any not started by then are deferred to the next run.': None,
+        'Budget': .8,
+    }
+
+    config['LATEDATA'] = {
+        '; Each run checks partial and missing windows from the last Hours for': None,
+        '; data that arrived late, and regenerates those that gained at least': None,
+        '; MinGain (fraction of the window) of coverage. Windows whose data turns': None,
+        '; out to be unchanged are left alone': None,
+        'Hours': 2,
+        'MinGain': 0.001,
+    }
+
+    config['QUEUE'] = {
+        '; Windows are claimed in a shared work queue before being generated, so': None,
+        '; several generator hosts can share the stations without doing any twice.': None,
+        '; Store is the queue type (sqlite). For more than one host, Path must be': None,
+        '; on storage they all share. Relative to the specgen directory if it does': None,
+        '; not start with /. Blank uses the cache DB': None,
+        '; The availability records (and their data digests, for late data), the': None,
+        '; backfill and retention progress, and the overview tile locks are kept': None,
+        '; with it, so every host and the web server see the same ones.': None,
+        'Store': 'sqlite',
+        'Path': '',
+        '; Seconds before an unfinished claim expires, and the window is retried': None,
+        'LeaseSeconds': 900,
+        '; Windows claimed at a time. Each host only claims more once its workers': None,
+        '; are keeping up': None,
+        'ClaimSize': 16,
+        '; Name this generator holds claims and reports throughput under. Blank': None,
+        '; uses the host name': None,
+        'WorkerName': '',
+        '; Seconds to wait for another host to finish updating the queue': None,
+        'Timeout': 30,
+    }
+
+    config['PIPELINE'] = {
+        '; Threads each worker uses to write window files, so writing overlaps': None,
+        '; with computing the next window. Fetching uses the source connection': None,
+        '; pool (e.g. WINSTON/PoolSize), and computing the worker processes': None,
+        '; (DAEMON/Workers)': None,
+        'WriterThreads': 2,
+    }
+
+    config['BACKFILL'] = {
+        '; Hours of data to fetch per station per request when backfilling': None,
+        'ChunkHours': 6,
+    }
+
+    config['DAEMON'] = {
+        '; Settings for running the generator as a resident process (run_generate.py --daemon)': None,
+        '; Seconds after each image boundary to wait before generating': None,
+        'Delay': 0,
+        '; Number of worker processes. 0 means one per CPU': None,
+        'Workers': 0,
+        '; JSON file the daemon keeps its current state in, for health checks.': None,
+        '; Relative to the specgen directory if it does not start with /': None,
+        'StatusFile': 'cache/status.json',
+    }
+
+    config['AVAILABILITY'] = {
+        '; Fraction of a window that must have data for it to be recorded as': None,
+        '; ok rather than partial': None,
+        'Complete': 0.99,
+    }
+
+    config['RETENTION'] = {
+        '; Used by run_retention.py. Days of data kept at full resolution. After': None,
+        '; that, only the thumbnails, a decimated spectrogram and a waveform': None,
+        '; envelope are kept': None,
+        'FullDays': 30,
+        '; Factor to decimate the spectrogram by (in time) when compacting': None,
+        'Decimate': 4,
+        '; Months after which data is deleted altogether. 0 keeps it forever': None,
+        'KeepMonths': 0,
+    }
+
+    config['OVERVIEW'] = {
+        '; Build hourly and daily overview tiles from the 10 minute spectra,': None,
+        '; for browsing long time spans': None,
+        'Enabled': True,
+    }
+
+    config['WEB'] = {
+        '; Rendered full images are cached in memory (per web server process)': None,
+        '; and on disk (shared). Relative to the specgen directory if it does': None,
+        '; not start with /': None,
+        'CacheDir': 'cache/images',
+        'MemoryCacheItems': 64,
+        'DiskCacheMB': 512,
+        '; Windows older than this are considered complete, and clients may': None,
+        '; cache images of them for ClosedMaxAge seconds without checking back': None,
+        'ClosedAfterMinutes': 120,
+        'ClosedMaxAge': 86400,
+        '; Threads used to load station files for an image': None,
+        'LoadThreads': 8,
+        '; Number of images that may be drawn at once per web server process,': None,
+        '; and how long (seconds) a request waits for a free slot before': None,
+        '; getting a 503': None,
+        'RenderSlots': 2,
+        'RenderWait': 30,
+        '; Longest time range (hours) a single full image may cover': None,
+        'MaxImageHours': 168,
+        '; Most stations a single image or mosaic may show': None,
+        'MaxStations': 10,
     }
 
     config['MySQL'] = {
@@ -36,6 +159,7 @@ def main():
 
     # Data filters to apply to the raw data
     config['FILTER'] = {
+        'Enabled': True,
         'LowCut': .5,
         'HighCut': 15,
         'Order': 2,
@@ -50,6 +174,49 @@ def main():
         'MaxFreq': 10,
         'MinFreq': 0,
         'padding': 10,
+        '; Carry spectrogram and filter state over from one window to the next,': None,
+        '; so there are no gaps at window boundaries. Spectra are computed from': None,
+        '; data filtered per the FILTER section.': None,
+        'Streaming': False,
+        '; Only compute the spectrogram up to MaxFreq, by low passing and': None,
+        '; downsampling the data first. Much less work for high rate channels.': None,
+        '; The peaks and the mean level at each frequency match the full': None,
+        '; computation, but individual low level cells can differ by a few dB.': None,
+        'BandLimit': False,
+        '; Maximum number of stations each worker computes in a single batch': None,
+        'BatchSize': 16,
+        '; Threads each worker may use for FFTs': None,
+        'FFTWorkers': 1,
+    }
+
+    config['STORAGE'] = {
+        '; How segment waveform data is stored. raw files can be memory mapped,': None,
+        '; zlib files are smaller but must be decompressed to read': None,
+        'Codec': 'raw',
+        '; zlib compression level (1-9)': None,
+        'Level': 1,
+        '; How computed spectrograms are stored. float32 keeps the full dB': None,
+        '; values, uint8 quantizes them over the displayed range (-360 to -180': None,
+        '; dB), which is a quarter of the size and is drawn by table lookup': None,
+        'Spectra': 'float32',
+        '; Append the segment, spectra and thumbnail of each window to a single': None,
+        '; container file per station-day, rather than writing separate files.': None,
+        '; Loose and packed files can be mixed, so this can be turned on at any time': None,
+        'Pack': False,
+    }
+
+    config['RENDER'] = {
+        '; How to draw the thumbnail images. One of:': None,
+        ';   raster - draw directly with numpy (fast)': None,
+        ';   matplotlib - strip down the full matplotlib figure (slow)': None,
+        'Thumbnail': 'raster',
+        '; Image format for thumbnails and overview tiles. One of:': None,
+        ';   png - palette indexed PNG (raster thumbnails only, else as rgb)': None,
+        ';   rgb - truecolor PNG': None,
+        ';   webp - lossless WebP, smaller still but slower to write': None,
+        'ThumbnailFormat': 'png',
+        '; Compression effort, 0-9 (0-6 for webp)': None,
+        'ThumbnailLevel': 6,
     }
 
     # Get any enviroment variable overrides
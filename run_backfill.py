@@ -0,0 +1,4 @@
+from specgen.backfill import main
+
+if __name__ == "__main__":
+    main()
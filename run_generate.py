@@ -1,8 +1,19 @@
+import argparse
 import time
 
 from specgen.generate import main
 
 if __name__ == "__main__":
-    t1 = time.time()
-    main()
-    print("Completed generation for all volcanos in", time.time() - t1)
+    parser = argparse.ArgumentParser(description = "Generate seismic spectrograms")
+    parser.add_argument('--daemon', action = 'store_true',
+                        help = "Stay running and generate on every image boundary, "
+                        "rather than doing a single run")
+    args = parser.parse_args()
+
+    if args.daemon:
+        from specgen import daemon
+        daemon.main()
+    else:
+        t1 = time.time()
+        main()
+        print("Completed generation for all volcanos in", time.time() - t1)
@@ -65,7 +65,8 @@ if __name__ == "__main__":
     print()
     print("Your install is set up and ready to go. To generate spectrograms and")
     print('run hooks (if installed), run the "run_generate" script. You will')
-    print('typically want to run this as a cron job every 10 minutes.')
+    print('typically want to run this as a cron job every 10 minutes, or run it')
+    print('once with the --daemon flag to keep it resident.')
     print()
     print("The web interface can be launched in development mode by running run_web.py")
     print("For production use, it is recommended that you instead use a production-")
@@ -0,0 +1,145 @@
+"""
+Persistent index of the segments produced for each station and window.
+
+Every window the generator processes is recorded in the cache DB with its
+status, the fraction of the window actually covered by data, and a digest of
+the data it was generated from (see generate.data_digest):
+
+    ok       the segment was generated, with (nearly) complete data
+    partial  the segment was generated, but the data has gaps
+    missing  there was no data, or the segment couldn't be generated
+
+Windows are keyed by their end time, the same as the image files.
+"""
+import sqlite3
+
+from obspy import UTCDateTime
+
+from .config import config
+
+CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS availability (
+    station TEXT,
+    endtime TEXT,
+    status TEXT,
+    coverage REAL,
+    updated TEXT,
+    digest TEXT,
+    PRIMARY KEY (station, endtime)
+)
+"""
+
+
+def _init(conn):
+    conn.execute(CREATE_SQL)
+    # Tables made before digests were recorded
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(availability)")]
+    if 'digest' not in columns:
+        try:
+            conn.execute("ALTER TABLE availability ADD COLUMN digest TEXT")
+        except sqlite3.OperationalError:
+            # Another worker got there first
+            pass
+
+
+def status(coverage, generated = True):
+    if not generated or not coverage:
+        return 'missing'
+    if coverage >= config.getfloat('AVAILABILITY', 'complete', fallback = .99):
+        return 'ok'
+    return 'partial'
+
+
+def timestamp(when):
+    # Consistent (and so sortable) text form for the DB
+    return UTCDateTime(when).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def record(cache_db, entries):
+    # entries is an iterable of (station, endtime, status, coverage, digest) tuples
+    updated = timestamp(UTCDateTime())
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        conn.executemany("""INSERT OR REPLACE INTO availability
+                            (station, endtime, status, coverage, updated, digest)
+                            VALUES (?,?,?,?,?,?)""",
+                         ((station, timestamp(end), window_status, coverage, updated, digest)
+                          for station, end, window_status, coverage, digest in entries))
+        conn.commit()
+
+
+def query(cache_db, stations, start, end):
+    """
+    Recorded windows for the given stations ending after start, up to and
+    including end. Returns {station: {endtime: (status, coverage)}}
+    """
+    result = {sta: {} for sta in stations}
+    if not stations:
+        return result
+
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        placeholders = ','.join('?' * len(stations))
+        cur = conn.execute(f"""SELECT station, endtime, status, coverage
+                               FROM availability
+                               WHERE station IN ({placeholders})
+                               AND endtime > ? AND endtime <= ?""",
+                           (*stations, timestamp(start), timestamp(end)))
+        for station, endtime, window_status, coverage in cur:
+            result[station][endtime] = (window_status, coverage)
+
+    return result
+
+
+def last_updated(cache_db, stations, start, end):
+    # When any of the given windows was last (re)generated, or None
+    if not stations:
+        return None
+
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        placeholders = ','.join('?' * len(stations))
+        cur = conn.execute(f"""SELECT MAX(updated) FROM availability
+                               WHERE station IN ({placeholders})
+                               AND endtime > ? AND endtime <= ?""",
+                           (*stations, timestamp(start), timestamp(end)))
+        return cur.fetchone()[0]
+
+
+def forget(cache_db, station, start, end):
+    # Remove a station's windows ending from start up to (not including) end,
+    # for data that has been deleted
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        conn.execute("""DELETE FROM availability
+                        WHERE station = ? AND endtime >= ? AND endtime < ?""",
+                     (station, timestamp(start), timestamp(end)))
+        conn.commit()
+
+
+def incomplete(cache_db, start, end):
+    """
+    Windows ending after start, up to and including end, that are partial
+    or missing, as a list of (station, endtime, status, coverage).
+    """
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        cur = conn.execute("""SELECT station, endtime, status, coverage FROM availability
+                              WHERE status != 'ok' AND endtime > ? AND endtime <= ?""",
+                           (timestamp(start), timestamp(end)))
+        return cur.fetchall()
+
+
+def digests(cache_db, windows):
+    # The recorded digests of the given (station, endtime) windows, as a dict
+    result = {}
+    with sqlite3.connect(cache_db, timeout = 30) as conn:
+        _init(conn)
+        for station, end in windows:
+            row = conn.execute("""SELECT digest FROM availability
+                                  WHERE station = ? AND endtime = ?""",
+                               (station, timestamp(end))).fetchone()
+            if row is not None and row[0] is not None:
+                result[(station, timestamp(end))] = row[0]
+
+    return result
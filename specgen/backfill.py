@@ -0,0 +1,188 @@
+"""
+Regenerate spectrograms for a past time range.
+
+The range is split per station into chunks of several hours. Each chunk is
+fetched from the waveform source as one contiguous request and then cut up
+into image windows, with chunks spread over a process pool. Windows that
+already have a spectra file are skipped (unless --force), and chunks that
+finish with no missing windows are recorded in the cache DB, so an
+interrupted backfill can simply be run again to pick up where it left off.
+
+    python run_backfill.py --volcano Spurr --start 2023-01-01 --end 2023-02-01
+"""
+import argparse
+import sqlite3
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from obspy import UTCDateTime
+
+from . import generate, pack, spectra
+from .config import config, locations, stations
+from .waveform import fetch
+
+
+def chunk_ranges(start, end, chunk_seconds, interval):
+    # Split start..end into chunks made of whole image windows
+    windows_per_chunk = max(1, int(chunk_seconds // interval))
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + windows_per_chunk * interval, end)
+        yield (chunk_start, chunk_end)
+        chunk_start = chunk_end
+
+
+def init_db(cache_db):
+    with sqlite3.connect(cache_db) as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS backfill (
+            station TEXT,
+            dtfrom TEXT,
+            dtto TEXT,
+            generated INTEGER,
+            missed INTEGER,
+            completed TEXT,
+            UNIQUE (station, dtfrom, dtto)
+        )""")
+
+
+def completed_chunks(cache_db):
+    with sqlite3.connect(cache_db) as conn:
+        cur = conn.execute("SELECT station, dtfrom, dtto FROM backfill")
+        return set(cur.fetchall())
+
+
+def mark_complete(cache_db, station, start, end, generated, missed):
+    with sqlite3.connect(cache_db) as conn:
+        conn.execute("""INSERT OR REPLACE INTO backfill
+                        (station, dtfrom, dtto, generated, missed, completed)
+                        VALUES (?,?,?,?,?,?)""",
+                     (station, start.isoformat(), end.isoformat(), generated,
+                      missed, UTCDateTime().isoformat()))
+        conn.commit()
+
+
+def backfill_chunk(station, sta_dict, start, end, interval, force = False):
+    """
+    Generate all the missing windows for one station between start and end.
+    Returns (generated, missed, skipped) counts.
+    """
+    img_base = generate.plot_dir()
+
+    jobs = []
+    skipped = 0
+    window_end = start + interval
+    while window_end <= end:
+        filepath = generate.image_path(img_base, station, window_end)
+        # Compacted windows (see retention) only keep their spectra file
+        if not force and pack.exists(spectra.spectra_path(filepath)):
+            skipped += 1
+        else:
+            jobs.append((filepath, station, sta_dict, window_end - interval, window_end))
+        window_end += interval
+
+    if not jobs:
+        return (0, 0, skipped)
+
+    # One request for everything this chunk still needs, cut into windows
+    # locally. Slices are views on the fetched data, not copies.
+    data = fetch([generate.station_request(station, sta_dict,
+                                           jobs[0][3], jobs[-1][4])])[0]
+    batch = [job + (data.slice(job[3], job[4]), ) for job in jobs]
+
+    # These windows are out of order as far as the live streaming state is
+    # concerned, so leave it alone.
+    missed_flags = generate.generate_spectrograms(batch, use_streaming = False,
+                                                  skip_unchanged = not force)
+    missed = sum(missed_flags)
+    return (len(jobs) - missed, missed, skipped)
+
+
+def backfill(station_list, start, end, chunk_hours = None, workers = None,
+             force = False):
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    if chunk_hours is None:
+        chunk_hours = config.getfloat('BACKFILL', 'chunkhours', fallback = 6)
+
+    # Snap to whole image windows
+    start = generate.window_end(UTCDateTime(start))
+    end = generate.window_end(UTCDateTime(end))
+
+    cache_db = generate.cache_db_path()
+    init_db(cache_db)
+    done = completed_chunks(cache_db)
+
+    work = []
+    for station in station_list:
+        for chunk_start, chunk_end in chunk_ranges(start, end, chunk_hours * 3600, interval):
+            if not force and (station, chunk_start.isoformat(), chunk_end.isoformat()) in done:
+                continue
+            work.append((station, chunk_start, chunk_end))
+
+    print("Backfilling", len(work), "chunks for", len(station_list), "stations",
+          f"({len(done)} chunks previously completed)")
+
+    totals = {'generated': 0, 'missed': 0, 'skipped': 0, 'failed_chunks': 0}
+    with ProcessPoolExecutor(max_workers = workers,
+                             initializer = generate.init_worker) as executor:
+        futures = {
+            executor.submit(backfill_chunk, station, stations[station],
+                            chunk_start, chunk_end, interval, force): (station, chunk_start, chunk_end)
+            for station, chunk_start, chunk_end in work
+        }
+
+        for future in as_completed(futures):
+            station, chunk_start, chunk_end = futures[future]
+            try:
+                generated, missed, skipped = future.result()
+            except Exception as e:
+                print("Backfill failed for", station, chunk_start, "-", chunk_end, e)
+                totals['failed_chunks'] += 1
+                continue
+
+            totals['generated'] += generated
+            totals['missed'] += missed
+            totals['skipped'] += skipped
+            # Chunks with missing windows are left to be retried next time
+            if not missed:
+                mark_complete(cache_db, station, chunk_start, chunk_end, generated, missed)
+
+    return totals
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Regenerate spectrograms for a past time range")
+    group = parser.add_mutually_exclusive_group(required = True)
+    group.add_argument('--volcano', action = 'append',
+                       help = "Backfill all stations for this volcano. May be repeated.")
+    group.add_argument('--stations', help = "Comma separated list of stations")
+    parser.add_argument('--start', required = True, help = "Start time (UTC), e.g. 2023-01-01T00:00")
+    parser.add_argument('--end', help = "End time (UTC). Default now.")
+    parser.add_argument('--chunk-hours', type = float,
+                        help = "Hours of data to fetch at a time, per station")
+    parser.add_argument('--workers', type = int, help = "Number of worker processes")
+    parser.add_argument('--force', action = 'store_true',
+                        help = "Regenerate segments that already exist, and "
+                        "ignore previously recorded progress")
+    args = parser.parse_args(argv)
+
+    if args.stations:
+        station_list = [sta.strip() for sta in args.stations.split(',')]
+    else:
+        station_list = []
+        for volc in args.volcano:
+            station_list += [sta for sta, _ in locations[volc]['stations']
+                             if sta not in station_list]
+
+    unknown = [sta for sta in station_list if sta not in stations]
+    if unknown:
+        parser.error(f"Unknown stations: {', '.join(unknown)}")
+
+    t1 = time.time()
+    totals = backfill(station_list, args.start, args.end or UTCDateTime(),
+                      args.chunk_hours, args.workers, args.force)
+    print("Backfill complete in", time.time() - t1, totals)
+
+
+if __name__ == "__main__":
+    main()
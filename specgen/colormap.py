@@ -1,6 +1,10 @@
 from functools import lru_cache
+
+import numpy
 from matplotlib.colors import ListedColormap
 
+from .spectra import NORM_MAX, NORM_MIN, dequantize
+
 
 @lru_cache  # Might as well cache the result, since it doesn't change. Ever.
 def spectro_map(N = 1024):
@@ -80,3 +84,42 @@ def spectro_map(N = 1024):
 
     cm = ListedColormap(cm_values)
     return cm
+
+
+@lru_cache
+def spectro_palette():
+    """
+    The spectrogram colormap as an (N, 3) uint8 RGB lookup table, followed by
+    white and black for the background and waveform.
+    """
+    colors = numpy.asarray(spectro_map().colors)[:, :3]
+    colors = numpy.vstack([colors, [[1, 1, 1], [0, 0, 0]]])
+    palette = numpy.round(colors * 255).astype(numpy.uint8)
+    palette.flags.writeable = False
+    return palette
+
+
+def _color_index(power):
+    N = len(spectro_palette()) - 2
+    scaled = (numpy.asarray(power) - NORM_MIN) * (N / (NORM_MAX - NORM_MIN))
+    idx = numpy.nan_to_num(scaled, nan = 0, posinf = N - 1, neginf = 0)
+    return numpy.clip(idx, 0, N - 1).astype(numpy.uint8)
+
+
+@lru_cache
+def quantized_colors():
+    # Palette index for each quantized (uint8) power value
+    colors = _color_index(dequantize(numpy.arange(256, dtype = numpy.uint8)))
+    colors.flags.writeable = False
+    return colors
+
+
+def color_index(power):
+    """
+    Map power to palette indexes, clipping out of range values to the end
+    colors, the same as matplotlib does for under/over values. Quantized
+    (uint8) power is mapped with a straight table lookup.
+    """
+    if power.dtype == numpy.uint8:
+        return quantized_colors()[power]
+    return _color_index(power)
@@ -0,0 +1,140 @@
+"""
+Long-running generator.
+
+Rather than being started by cron every MinutesPerImage minutes, this stays
+resident and wakes on each image boundary. The worker processes, and any
+connections held by the waveform source, are kept alive between runs. Runs
+never overlap: if one runs long, any boundaries it skipped are queued as
+missed (see workqueue) to be picked up by the next run.
+
+Current state is written to a JSON status file (DAEMON/StatusFile) after
+every state change, for health checks.
+"""
+import json
+import os
+import signal
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from obspy import UTCDateTime
+
+from . import generate
+from .config import config, stations
+from .sources import get_source
+
+
+class StatusFile:
+    def __init__(self, path):
+        self.path = path
+        self.status = {
+            'pid': os.getpid(),
+            'started': UTCDateTime().isoformat(),
+            'state': 'starting',
+            'runs': 0,
+            'failed_runs': 0,
+            'last_run': None,
+            'next_run': None,
+        }
+
+    def update(self, **kwargs):
+        self.status.update(kwargs)
+        self.status['updated'] = UTCDateTime().isoformat()
+
+        # Write to a temp file and move into place, so readers never see a
+        # partially written file.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as status_file:
+            json.dump(self.status, status_file, indent = 2)
+        os.replace(tmp_path, self.path)
+
+
+def status_path():
+    path = config.get('DAEMON', 'statusfile', fallback = 'cache/status.json')
+    if not path.startswith('/'):
+        path = os.path.join(os.path.dirname(__file__), path)
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    return path
+
+
+def make_executor():
+    workers = config.getint('DAEMON', 'workers', fallback = 0) or None
+    return ProcessPoolExecutor(max_workers = workers,
+                               initializer = generate.init_worker)
+
+
+def main():
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    # Seconds after each boundary to wait before running, to give late
+    # packets a chance to arrive.
+    delay = config.getfloat('DAEMON', 'delay', fallback = 0)
+
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        print("Received signal", signum, "shutting down after current run")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    status = StatusFile(status_path())
+    executor = make_executor()
+    source = get_source()  # Created here so it lives for the life of the daemon
+
+    last_end = None
+    try:
+        while not stop.is_set():
+            next_end = generate.window_end(UTCDateTime()) + interval
+            status.update(state = 'idle', next_run = next_end.isoformat())
+
+            # Sleep until the next boundary, waking early if asked to stop
+            if stop.wait(max(0, next_end + delay - UTCDateTime())):
+                break
+
+            # If the previous run went long enough to skip a boundary, queue
+            # the skipped windows as missed so this run picks them up.
+            if last_end is not None:
+                skipped = []
+                end = last_end + interval
+                while end < next_end:
+                    skipped.extend((sta, end - interval, end) for sta in stations)
+                    end += interval
+
+                if skipped:
+                    print("Run overlap: queuing", len(skipped), "skipped segments")
+                    generate.record_missed(skipped)
+
+            status.update(state = 'running', run_start = UTCDateTime().isoformat())
+            t1 = time.time()
+            try:
+                result = generate.run(executor, next_end)
+            except BrokenProcessPool as e:
+                # A worker died hard. Replace the pool and carry on.
+                print("Worker pool broken, restarting:", e)
+                executor.shutdown(wait = False)
+                executor = make_executor()
+                status.update(failed_runs = status.status['failed_runs'] + 1)
+                continue
+            except Exception as e:
+                print("Run failed:", e)
+                status.update(failed_runs = status.status['failed_runs'] + 1,
+                              last_error = str(e))
+                continue
+            finally:
+                last_end = next_end
+
+            result['duration'] = time.time() - t1
+            print("Completed run for", next_end, "in", result['duration'])
+            status.update(runs = status.status['runs'] + 1, last_run = result)
+    finally:
+        status.update(state = 'stopped', next_run = None)
+        executor.shutdown()
+        source.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,20 @@
-import bz2
+import hashlib
 import os
-import pickle
-import sqlite3
+import time
 
 
-from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy
 
-from matplotlib import pyplot as plt
 from obspy import UTCDateTime
 
 
-from . import graphing
+from . import (availability, graphing, overview, pack, raster, segment, shared, spectra,
+               streaming, workqueue)
 
-from .waveform import load
+from .waveform import coverage, fetch, fetch_coverage, fetch_each, prepare
 from .config import config, stations
 
 
@@ -20,7 +22,57 @@ class AvailabilityError(Exception):
     pass
 
 
+# (pid, pool) of the writer threads, see writer
+_writer = (None, None)
+
+
 def main():
+    with ProcessPoolExecutor(initializer = init_worker) as executor:
+        return run(executor)
+
+
+def init_worker():
+    # Pay the one-time costs (font cache, colormap, first figure) up front, so
+    # the first real spectrogram in each worker doesn't have to.
+    graphing.warm_up()
+
+
+def window_end(when):
+    # The closest image boundary at or prior to the given time
+    minutes = config['GLOBAL'].getint('minutesperimage', 10)
+    return when.replace(minute=when.minute - (when.minute % minutes),
+                        second=0,
+                        microsecond=0)
+
+
+def cache_db_path():
+    # Kept with the work queue, so that with several generator hosts each one
+    # sees what the others have generated
+    return workqueue.shared_db_path()
+
+
+def plot_dir():
+    plot_loc = config['GLOBAL']['plotimgdir']
+    script_loc = os.path.dirname(__file__)
+
+    if not plot_loc.startswith('/'):
+        return os.path.realpath(os.path.join(script_loc, plot_loc))
+
+    return plot_loc
+
+
+def record_missed(missed):
+    # missed is an iterable of (station, starttime, endtime) tuples, to be
+    # retried by the next run (on whichever host gets to them first)
+    workqueue.get_queue().add_missed(list(missed))
+
+
+def run(executor, ENDTIME = None):
+    """
+    Generate spectrograms for the window ending at ENDTIME (default: the most
+    recent image boundary), along with any recently missed windows, using the
+    supplied executor. Returns a summary of the run.
+    """
     #     tempdir = os.path.join(tempfile.gettempdir(), "specgenTemp")
     #     if os.path.exists(tempdir):
     #         shutil.rmtree(tempdir)
@@ -28,92 +80,284 @@ def main():
     #     print("Creating tempdir:", tempdir)
     #     os.makedirs(tempdir, exist_ok = True)
 
-    # TODO: figure out and loop through all time ranges that need to be generated
-    # (i.e. current, missed in previous run, etc)
+    run_start = time.monotonic()
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    # Retries only get whatever is left of this much of the interval, so the
+    # run is done before the next one is due.
+    deadline = run_start + interval * config.getfloat('SCHEDULER', 'budget', fallback = .8)
 
     # Set endtime to the closest 10 minute mark prior to current time
-    ENDTIME = UTCDateTime()
-    ENDTIME = ENDTIME.replace(minute=ENDTIME.minute - (ENDTIME.minute % 10),
-                              second=0,
-                              microsecond=0)
-
-    STARTTIME = ENDTIME - (config['GLOBAL'].getint('minutesperimage', 10) * 60)
-
-    gen_times = [(STARTTIME, ENDTIME, None)]
-
-    cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
-    os.makedirs(cache_dir, exist_ok = True)
-    cache_db = os.path.join(cache_dir, 'cache.db')
-    with sqlite3.connect(cache_db) as conn:
-        cur = conn.cursor()
-        # Make sure the "missed" table exists
-        cur.execute("CREATE TABLE IF NOT EXISTS missed (station TEXT, dtfrom TEXT, dtto TEXT, UNIQUE (station, dtfrom, dtto))")
-        cur.execute("SELECT station,dtfrom,dtto FROM missed ORDER BY dtto DESC")  # May be empty
-
-        for station, dtfrom, dtto in cur:
-            loc = {station: stations[station]}
-            dtfrom = UTCDateTime(dtfrom)
-            dtto = UTCDateTime(dtto)
-            if (UTCDateTime() - dtfrom) / 60 / 60 > 2:
-                continue  # Don't try to go back more than two hours
-            gen_times.append((dtfrom, dtto, loc))
-
-        cur.execute("DELETE FROM missed")  # Potential race condition between SELECT and DELETE?
-
-    plot_loc = config['GLOBAL']['plotimgdir']
-    script_loc = os.path.dirname(__file__)
+    if ENDTIME is None:
+        ENDTIME = UTCDateTime()
+    ENDTIME = window_end(ENDTIME)
+
+    STARTTIME = ENDTIME - interval
+
+    # Every window is claimed in the work queue before anything is fetched
+    # for it, so that generators on other hosts sharing the queue don't do it
+    # too (see workqueue).
+    queue = workqueue.get_queue()
+    owner = workqueue.worker_name()
+    claimed_at = time.time()
+
+    # Missed windows, and those whose lease ran out (the generator working on
+    # them died), are retried, as long as they aren't too old
+    oldest = UTCDateTime() - late_hours() * 3600
+    queue.purge(oldest)
+    retry_times = [(start, end, {station: stations[station]})
+                   for station, start, end in queue.retryable(oldest) if station in stations]
+
+    # The current window always goes first, and is always waited for.
+    current = submit_claimed(executor, make_jobs([(STARTTIME, ENDTIME, None)]))
+
+    # Retries (of missed windows, and of recent windows that the source has
+    # since received more data for) are queued behind it, as long as there
+    # is any time left. Any left over stay in the queue for the next run.
+    retry_jobs = []
+    deferred = []
+    if time.monotonic() < deadline:
+        retry_jobs = late_jobs(retry_times, STARTTIME, claimed_at)
+    else:
+        deferred = [(station, start, end) for start, end, locs in retry_times for station in locs]
 
-    if not plot_loc.startswith('/'):
-        img_base = os.path.realpath(os.path.join(script_loc, plot_loc))
+    retries = []
+    if retry_jobs and time.monotonic() < deadline:
+        retries = submit_batches(executor, retry_jobs)
     else:
-        img_base = plot_loc
+        queue.release(owner, job_units(retry_jobs))
+        deferred += job_units(retry_jobs)
+
+    missed, _ = collect(current)
+    current_done = time.monotonic() - run_start
+    retry_missed, retry_deferred = collect(retries, deadline)
+    missed += retry_missed
+    queue.release(owner, retry_deferred)
+    deferred += retry_deferred
+
+    if deferred:
+        print("Out of time, deferred", len(deferred), "retries to the next run:")
+        for station, start, end in deferred:
+            print("   ", station, start, "-", end)
+
+    # Everything claimed and not missed or deferred was generated
+    not_generated = {workqueue.unit_key(unit) for unit in missed + retry_deferred}
+    generated = [unit for batch, _ in current + retries for unit in job_units(batch)
+                 if workqueue.unit_key(unit) not in not_generated]
+    queue.complete(owner, generated, missed)
+    queue.record_run(owner, len(generated), len(missed), time.monotonic() - run_start)
+
+    return {
+        'starttime': STARTTIME.isoformat(),
+        'endtime': ENDTIME.isoformat(),
+        'worker': owner,
+        'current': sum(len(batch) for batch, _ in current),  # Current windows claimed
+        'generated': len(generated),
+        'retried': len(retry_jobs),
+        'missed': len(missed),
+        'deferred': len(deferred),
+        'current_seconds': current_done,  # Time until the current window was done
+    }
+
+
+def late_hours():
+    return config.getfloat('LATEDATA', 'hours', fallback = 2)
+
+
+def late_jobs(retry_times, current_start, claimed_at):
+    """
+    Jobs for the missed windows in retry_times, plus any partial or missing
+    windows from the last LATEDATA/Hours that the source now has more data
+    for. The source is only asked how much data it has for each window,
+    which is much cheaper than fetching and processing it, and just the
+    windows that gained data (or were never generated) are returned.
+
+    The windows are claimed in the work queue first, including ones that
+    were done before claimed_at, so only one generator checks each. The
+    ones returned stay claimed, and the rest are released.
+    """
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    min_gain = config.getfloat('LATEDATA', 'mingain', fallback = .001)
+
+    # (station, window end) -> (start, end, recorded status, recorded coverage)
+    windows = {}
+    for station, endtime, status, covered in availability.incomplete(
+            cache_db_path(), current_start - late_hours() * 3600, current_start):
+        if station in stations:
+            end = UTCDateTime(endtime)
+            windows[(station, endtime)] = (end - interval, end, status, covered)
+    for start, end, locs in retry_times:
+        for station in locs:
+            windows.setdefault((station, availability.timestamp(end)), (start, end, None, 0.0))
+
+    if not windows:
+        return []
+
+    keys = sorted(windows)
+    jobs = make_jobs([(windows[key][0], windows[key][1], {key[0]: stations[key[0]]})
+                      for key in keys])
+    claimed = {id(job) for job in claim_jobs(jobs, claimed_at)}
+    keys = [key for key, job in zip(keys, jobs) if id(job) in claimed]
+    jobs = [job for job in jobs if id(job) in claimed]
+    polled = fetch_coverage(station_request(loc, loc_info, start, end)
+                            for _, loc, loc_info, start, end in jobs)
+
+    late = []
+    unchanged = []
+    for job, key, now_covered in zip(jobs, keys, polled):
+        _, _, status, covered = windows[key]
+        if (status is None or (status == 'missing' and now_covered > 0)
+                or now_covered > covered + min_gain):
+            late.append(job)
+        else:
+            unchanged.append(job)
+
+    workqueue.get_queue().release(workqueue.worker_name(), job_units(unchanged))
+    print("Checked", len(jobs), "incomplete windows for late data,", len(late), "to regenerate")
+    return late
+
+
+def image_path(img_base, station, end):
+    # File path/name is based on ENDTIME
+    year = str(end.year)
+    month = str(end.month)
+    day = str(end.day)
+    filename = end.strftime('%Y%m%dT%H%M%S') + ".png"
+
+    path = os.path.join(img_base, station, year, month, day)
+    os.makedirs(path, exist_ok = True)
+    return os.path.join(path, filename)
+
+
+def make_jobs(gen_times):
+    # (filepath, station, station info, start, end) for each station/time range
+    img_base = plot_dir()
+
+    jobs = []
+    for start, end, locs in gen_times:
+        if locs is None:
+            locs = stations
+        for loc, loc_info in locs.items():
+            jobs.append((image_path(img_base, loc, end), loc, loc_info, start, end))
+
+    return jobs
+
+
+def job_units(jobs):
+    # The work queue units (see workqueue) for jobs
+    return [(STA, STARTTIME, ENDTIME) for _, STA, _, STARTTIME, ENDTIME, *_ in jobs]
+
+
+def claim_jobs(jobs, redo_before = None):
+    # The jobs whose windows could be claimed in the work queue
+    claimed = {workqueue.unit_key(unit) for unit in workqueue.get_queue().claim(
+        workqueue.worker_name(), job_units(jobs), workqueue.lease_seconds(), redo_before)}
+    return [job for job, unit in zip(jobs, job_units(jobs))
+            if workqueue.unit_key(unit) in claimed]
+
+
+def submit_claimed(executor, jobs):
+    """
+    Claim jobs in the work queue and submit the ones claimed, a QUEUE/ClaimSize
+    chunk at a time, returning the submitted batches as submit_batches does.
+
+    Each chunk is only claimed once this host has no more than one batch per
+    CPU waiting or running, so hosts sharing the queue each take on work as
+    fast as they get through it.
+    """
+    chunk_size = config.getint('QUEUE', 'claimsize', fallback = 16)
 
     procs = []
-    with ProcessPoolExecutor() as executor:
-        for start, end, locs in gen_times:
-            # File path/name is based on ENDTIME
-            year = str(end.year)
-            month = str(end.month)
-            day = str(end.day)
-            filename = end.strftime('%Y%m%dT%H%M%S') + ".png"
-
-            if locs is None:
-                locs = stations
-            for loc, loc_info in locs.items():
-                path = os.path.join(img_base, loc, year, month, day)
-                os.makedirs(path, exist_ok = True)
-                filepath = os.path.join(path, filename)
-                # generate_spectrogram(filepath, loc, loc_info, start, end)
-                future = executor.submit(generate_spectrogram, filepath,
-                                         loc, loc_info, start, end)
-                procs.append((loc, start, end, future))
-
-    INSERT_SQL = """
-    INSERT INTO missed
-    (station, dtfrom, dtto)
-    VALUES
-    (?,?,?)
-    """
-    for station, dtstart, dtend, proc in procs:
+    for i in range(0, len(jobs), chunk_size):
+        while True:
+            running = [future for _, future in procs if not future.done()]
+            if len(running) <= (os.cpu_count() or 1):
+                break
+            wait(running, return_when = FIRST_COMPLETED)
+
+        chunk = claim_jobs(jobs[i:i + chunk_size])
+        if chunk:
+            procs += submit_batches(executor, chunk)
+
+    return procs
+
+
+def submit_batches(executor, jobs):
+    """
+    Fetch the data for every station/time range, and hand the work to the
+    executor in batches, so each worker can run a single vectorized
+    spectrogram over several stations.
+
+    All the requests go to the source at once, so it can spread them over
+    its connections rather than each worker making its own. Stations are
+    grouped by sample rate so that batches stack cleanly, and each batch is
+    submitted as soon as its data is in, so the workers get going while the
+    rest is still arriving. The data reaches the workers through shared
+    memory (see shared) rather than being pickled.
+    """
+    batch_size = config.getint('SPECTROGRAM', 'batchsize', fallback = 16)
+    batch_size = max(1, min(batch_size, -(-len(jobs) // (os.cpu_count() or 1))))
+
+    procs = []
+    streams = {}
+
+    def submit(indexes):
+        shm, layouts = shared.share_streams([streams.pop(idx) for idx in indexes])
+        batch = [jobs[idx] for idx in indexes]
+        try:
+            future = executor.submit(generate_shared, shm.name, layouts, batch)
+        except Exception:
+            shared.release(shm)
+            raise
+        future.add_done_callback(lambda _: shared.release(shm))
+        procs.append((batch, future))
+
+    groups = defaultdict(list)
+    for idx, stream in fetch_each(station_request(loc, loc_info, start, end)
+                                  for _, loc, loc_info, start, end in jobs):
+        streams[idx] = stream
+        group = groups[jobs[idx][2].get('SAMPLE_RATE', 0)]
+        group.append(idx)
+        if len(group) == batch_size:
+            submit(group)
+            group.clear()
+
+    for group in groups.values():
+        if group:
+            submit(group)
+
+    return procs
+
+
+def collect(procs, deadline = None):
+    """
+    Wait for submitted batches, returning lists of the (station, start, end)
+    segments that were missed, and that were not started before the deadline
+    (a time.monotonic() value) and so were cancelled.
+    """
+    if deadline is not None:
+        wait([future for _, future in procs],
+             timeout = max(0, deadline - time.monotonic()))
+
+    missed = []
+    deferred = []
+    for batch, proc in procs:
+        segments = [(station, dtstart, dtend) for _, station, _, dtstart, dtend in batch]
+        # Anything still queued at the deadline is put off to the next run.
+        # Batches that are already running can't be stopped, so are waited on.
+        if deadline is not None and proc.cancel():
+            deferred += segments
+            continue
+
         try:
-            missed_flag = proc.result()
+            missed_flags = proc.result()
         except Exception as e:
             print(e)
-            missed_flag = True
+            missed_flags = [True] * len(batch)
 
-        if missed_flag:
-            with sqlite3.connect(cache_db) as conn:
-                cur = conn.cursor()
-                try:
-                    cur.execute(INSERT_SQL,
-                                (station,
-                                 dtstart.isoformat(),
-                                 dtend.isoformat()))
-                except sqlite3.IntegrityError:
-                    # Already marked this volc/timerange as missing
-                    continue
+        missed += [item for item, missed_flag in zip(segments, missed_flags)
+                   if missed_flag]
 
-                conn.commit()
+    return (missed, deferred)
 
 
 # def create_df(times, z_data, n_data, e_data):
@@ -169,36 +413,227 @@ def main():
 #             pass  # No run function, or bad signature
 
 
-def generate_spectrogram(filename, STA, sta_dict, STARTTIME, ENDTIME):
+def station_request(STA, sta_dict, STARTTIME, ENDTIME):
     CHAN = sta_dict.get('CHAN', 'BHZ')
     NET = sta_dict.get('NET', 'AV')
+    return (NET, STA, '--', CHAN, STARTTIME, ENDTIME)
+
+
+def generate_spectrogram(filename, STA, sta_dict, STARTTIME, ENDTIME, stream = None):
+    return generate_spectrograms([(filename, STA, sta_dict, STARTTIME, ENDTIME, stream)])[0]
+
+
+def generate_shared(name, layouts, jobs):
+    # generate_spectrograms for jobs without their streams, which are in the
+    # named shared memory block instead (see submit_batches)
+    shm, streams = shared.attach_streams(name, layouts)
+    try:
+        return generate_spectrograms([job + (stream, ) for job, stream in zip(jobs, streams)])
+    finally:
+        del streams
+        shared.detach(shm)
+
+
+def data_digest(trace):
+    """
+    A hash of everything that goes into a window's output: the samples and
+    their timing, and the settings they are processed with. The same digest
+    means regenerating the window would give the same files.
+    """
+    digest = hashlib.sha1()
+    stats = trace.stats
+    digest.update(f"{stats.starttime.timestamp} {stats.sampling_rate} {trace.data.dtype}".encode())
+    digest.update(spectra.params_key().encode())
+    digest.update(config.get('STORAGE', 'spectra', fallback = 'float32').encode())
+    digest.update(config.get('RENDER', 'thumbnail', fallback = 'raster').encode())
+    digest.update(graphing.thumbnail_format().encode())
+    digest.update(numpy.ascontiguousarray(trace.data).tobytes())
+    return digest.hexdigest()
+
+
+def generate_spectrograms(jobs, use_streaming = None, skip_unchanged = True):
+    """
+    Generate the spectrograms for a batch of (filename, STA, sta_dict,
+    STARTTIME, ENDTIME, stream) jobs. If stream is None, the data is loaded
+    from the waveform source. Returns a list of missed flags, one per job.
+
+    use_streaming defaults to the SPECTROGRAM/Streaming setting. With
+    skip_unchanged, windows whose data is the same as when they were last
+    generated are left as they are.
+    """
+    if use_streaming is None:
+        use_streaming = config.getboolean('SPECTROGRAM', 'streaming', fallback = False)
+
+    previous = {}
+    if skip_unchanged:
+        previous = availability.digests(cache_db_path(),
+                                        [(STA, ENDTIME) for _, STA, _, _, ENDTIME, _ in jobs])
+
+    missed = [True] * len(jobs)  # missed this station/time unless we get to the end
+    covered = [0.0] * len(jobs)
+    digests = [None] * len(jobs)
+    unchanged = [False] * len(jobs)
+    loaded = []
+    for idx, (filename, STA, sta_dict, STARTTIME, ENDTIME, stream) in enumerate(jobs):
+        # Bad data for one station only misses that station
+        try:
+            if stream is None:
+                # Get the data for this station from the waveform source
+                stream = fetch([station_request(STA, sta_dict, STARTTIME, ENDTIME)])[0]
+
+            # Before merging fills in any gaps
+            covered[idx] = coverage(stream, STARTTIME, ENDTIME)
+            stream, waveform_times = prepare(stream)
 
-    # Get the data for this station from the winston server
-    stream, waveform_times = load(NET, STA, '--', CHAN,
-                                  STARTTIME, ENDTIME)
+            if stream is None or waveform_times is None:
+                continue
 
-    if stream is None or waveform_times is None:
-        return True  # missed this station/time
+            # Get the raw z data as a numpy array
+            z_data = stream.select(component = 'Z').pop()
+            digests[idx] = data_digest(z_data)
+        except Exception as e:
+            print("Unable to load", filename, e)
+            continue
+
+        if (previous.get((STA, availability.timestamp(ENDTIME))) == digests[idx]
+                and pack.exists(spectra.spectra_path(filename))):
+            # Nothing has changed since this window was generated
+            missed[idx] = False
+            unchanged[idx] = True
+            continue
+
+        loaded.append((idx, waveform_times, z_data))
+
+    specs = [None] * len(loaded)
+    if use_streaming:
+        # Carry on from where the previous window for each station left off.
+        for pos, (idx, _, z_data) in enumerate(loaded):
+            try:
+                specs[pos] = streaming.process(jobs[idx][1], z_data)
+            except Exception as e:
+                # Computed on its own below instead
+                print("Unable to stream", jobs[idx][0], e)
+
+    # Everything else gets computed in one go
+    pending = [pos for pos, spec in enumerate(specs) if spec is None or len(spec[1]) == 0]
+    computed = graphing.compute_spectrograms([loaded[pos][2] for pos in pending])
+    for pos, spec in zip(pending, computed):
+        specs[pos] = spec
+
+    # Files are handed to the writer threads as they are encoded, so the
+    # writing overlaps with encoding the next window. Consecutive windows for
+    # the same directory are written together, which for backfill batches
+    # (all one station) means a single write per station-day.
+    writes = []
+    pending = []
+
+    def flush():
+        if pending:
+            indexes = [idx for idx, _ in pending]
+            files = [item for _, window_files in pending for item in window_files]
+            writes.append((indexes, writer().submit(write_windows, files)))
+            pending.clear()
+
+    for (idx, waveform_times, z_data), spec in zip(loaded, specs):
+        filename = jobs[idx][0]
+        try:
+            files = encode_window(filename, waveform_times, z_data, spec)
+        except Exception as e:
+            print("Unable to generate", filename, e)
+            continue
+
+        if pending and os.path.dirname(jobs[pending[-1][0]][0]) != os.path.dirname(filename):
+            flush()
+        pending.append((idx, files))
+    flush()
+
+    for indexes, write in writes:
+        try:
+            write.result()
+        except Exception as e:
+            print("Unable to write", ", ".join(jobs[idx][0] for idx in indexes), e)
+            continue
+
+        for idx in indexes:
+            print(jobs[idx][0])
+            missed[idx] = False  # Did NOT miss this station
 
-    # Get the raw z data as a numpy array
-    z_data = stream.select(component = 'Z').pop()
+    availability.record(cache_db_path(), (
+        (STA, ENDTIME, availability.status(covered[idx], not missed[idx]), covered[idx],
+         digests[idx] if not missed[idx] else None)
+        for idx, (_, STA, _, _, ENDTIME, _) in enumerate(jobs)
+        if not unchanged[idx]
+    ))
 
-    data_file = filename[:-3] + "pbz2"
-    with bz2.BZ2File(data_file, 'w') as figure_file:
-        pickle.dump(waveform_times, figure_file)
-        pickle.dump(z_data, figure_file)
+    if overview.enabled():
+        update_overviews([job for idx, job in enumerate(jobs)
+                          if not missed[idx] and not unchanged[idx]])
 
-    print(filename)
-    # Save the thumbnail for this spectrogram
-    fig = graphing.gen_spectrograph(waveform_times, z_data)
-    graphing.gen_thumbnail(filename, fig)
-    plt.close(fig)
+    return missed
 
-    return False  # Did NOT miss this station
+
+def encode_window(filename, waveform_times, z_data, spec):
+    """
+    The segment, spectra (so the web app doesn't have to recompute it) and
+    thumbnail files for a window, as [(filename, data), ...].
+    """
+    if config.get('RENDER', 'thumbnail', fallback = 'raster') == 'raster':
+        thumbnail = raster.encode_image(raster.render_thumbnail(waveform_times, z_data, spec))
+    else:
+        thumbnail = graphing.encode_thumbnail(waveform_times, z_data, spec)
+
+    return [
+        (segment.segment_path(filename), segment.encode(z_data)),
+        (spectra.spectra_path(filename), spectra.encode(spec)),
+        (graphing.thumbnail_path(filename), thumbnail),
+    ]
+
+
+def write_windows(files):
+    """
+    Write [(filename, data), ...], all in the same directory, as loose files
+    or appended to the station-day container in a single write, per
+    STORAGE/Pack.
+    """
+    if pack.enabled():
+        pack.append(files)
+        return
+
+    for filename, data in files:
+        tmp_name = f"{filename}.tmp"
+        with open(tmp_name, 'wb') as out_file:
+            out_file.write(data)
+        os.replace(tmp_name, filename)
+
+
+def writer():
+    # The pool of PIPELINE/WriterThreads threads writing window files for
+    # this process. Made on first use, and made again in a forked worker,
+    # which doesn't get the threads.
+    global _writer
+    pid, pool = _writer
+    if pid != os.getpid():
+        pool = ThreadPoolExecutor(max_workers = config.getint('PIPELINE', 'writerthreads',
+                                                              fallback = 2))
+        _writer = (os.getpid(), pool)
+    return pool
+
+
+def update_overviews(jobs):
+    # Rebuild the coarse overview tiles covering the windows just generated
+    windows = defaultdict(list)
+    for filename, STA, sta_dict, STARTTIME, ENDTIME, stream in jobs:
+        windows[STA].append(STARTTIME)
+
+    img_base = plot_dir()
+    for STA, starts in windows.items():
+        try:
+            overview.update(img_base, STA, starts)
+        except Exception as e:
+            print("Unable to update overview tiles for", STA, e)
 
 
 if __name__ == "__main__":
-    import time
     t1 = time.time()
     main()
     print("Completed run after:", time.time() - t1)
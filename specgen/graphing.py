@@ -1,20 +1,42 @@
 import os
+import threading
 import numpy
 
+from io import BytesIO
+
+from collections import defaultdict
+from functools import lru_cache
+
 import matplotlib
 matplotlib.use('Agg')
 
 import matplotlib.dates as mdates
 from matplotlib import pyplot as plt
 from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
 import pandas
-from scipy.signal import spectrogram
+from scipy.fft import set_workers
+from scipy.signal import decimate, sosfilt, sosfilt_zi, spectrogram
 
 from .config import config
-from .colormap import spectro_map
+from .colormap import color_index, spectro_map, spectro_palette
+from .spectra import NORM_MAX, NORM_MIN, crop, spectrogram_params
+from .streaming import bandpass
+
+# Keep Nyquist at least this much above MaxFreq when band limiting, so the
+# decimation filter's transition band stays clear of the displayed range.
+BAND_LIMIT_MARGIN = 1.25
+
+
+def warm_up():
+    # Build the reusable thumbnail figure and render it once, so matplotlib
+    # loads its fonts and caches before any real work is done.
+    figure = spectrograph_figure(thumbnail = True)
+    with figure.lock:
+        figure.fig.canvas.draw()
 
 
-def gen_spectrograph(times, data):
+def gen_spectrograph(times, data, spec = None):
     # Create a plot figure to hold the waveform and spectrogram graphs
     plot_height = 1.52
     plot_width = 5.76
@@ -32,7 +54,7 @@ def gen_spectrograph(times, data):
     # Configure the plot for this station
     ax1 = axes[0]
     ax2 = axes[1]
-    gen_station_subplots(times, data, ax1, ax2)
+    gen_station_subplots(times, data, ax1, ax2, spec)
 
     axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))  # Format dates as hour:minute
 
@@ -44,29 +66,132 @@ def gen_spectrograph(times, data):
     return fig
 
 
-def gen_station_subplots(times, data, ax1, ax2):
+def compute_spectrogram(data):
+    """
+    Run the spectrogram for an ObsPy trace using the configured parameters.
+
+    Returns (frequencies, times, power), with times as datetime64[s] and
+    power in dB.
+    """
+    return compute_spectrograms([data])[0]
+
+
+def compute_spectrograms(traces, workers = None):
+    """
+    Run the spectrogram for a list of ObsPy traces. Traces with the same
+    sample rate and length are stacked into a single 2-D array and computed
+    in one vectorized call, sharing the window and FFT setup.
+
+    workers is the number of threads scipy.fft may use (default
+    SPECTROGRAM/FFTWorkers). Returns a list of (frequencies, times, power)
+    in the same order as traces.
+    """
+    if workers is None:
+        workers = config.getint('SPECTROGRAM', 'fftworkers', fallback = 1)
+
+    groups = defaultdict(list)
+    for idx, trace in enumerate(traces):
+        groups[(trace.stats['sampling_rate'], len(trace.data))].append(idx)
+
+    specs = [None] * len(traces)
+    with set_workers(workers):
+        for (sample_rate, _), indexes in groups.items():
+            z_data = numpy.vstack([traces[idx].data for idx in indexes])
+            frequencies, offsets, power = _spectrogram(z_data, sample_rate)
+
+            for row, idx in enumerate(indexes):
+                # Convert the times returned from the spectrogram function (0-600 seconds)
+                # to real timestamps to line up with the waveform.
+                DATA_START = traces[idx].stats['starttime']
+                spectrograph_times = (offsets + DATA_START.timestamp).astype('datetime64[s]')
+
+                spec = (frequencies, spectrograph_times, power[row])
+                if spectrogram_params()['band_limit']:
+                    spec = crop(spec)  # Nothing outside the band is ever drawn
+
+                specs[idx] = spec
+
+    return specs
+
+
+def _spectrogram(z_data, sample_rate):
+    # Spectrogram along the last axis of z_data, with power in dB
     # spectrogram parameters
-    window_type = config['SPECTROGRAM']['WindowType']
-    window_size = config['SPECTROGRAM'].getint('WindowSize')
-    overlap = config['SPECTROGRAM'].getint('Overlap')
-    NFFT = config['SPECTROGRAM'].getint('NFFT')
+    params = spectrogram_params()
+    window_type = params['window_type']
+    window_size = params['window_size']
+    overlap = params['overlap']
+    NFFT = params['nfft']
+
+    if 'filter' in params:
+        # Filtered the same way as a streamed spectrogram starting afresh,
+        # since the stored results are tagged with the same parameters.
+        sos = bandpass(sample_rate)
+        z_data = numpy.asarray(z_data, dtype = numpy.float64)
+        zi = sosfilt_zi(sos)[:, None, :] * z_data[:, 0][None, :, None]
+        z_data, _ = sosfilt(sos, z_data, axis = -1, zi = zi)
+
+    factor = 1
+    if params['band_limit']:
+        factor = band_limit_factor(sample_rate, params)
+
+    if factor > 1:
+        # Only the displayed band is wanted, so low pass and downsample first.
+        # Scaling the window and FFT sizes by the same factor keeps the same
+        # time and frequency resolution, and (being a density) the same power.
+        z_data = decimate(z_data, factor, ftype = 'fir', zero_phase = True)
+        sample_rate /= factor
+        window_size //= factor
+        overlap //= factor
+        NFFT //= factor
+
+    frequencies, offsets, power = spectrogram(z_data, sample_rate, window_type,
+                                              nperseg = window_size,
+                                              noverlap = overlap, nfft = NFFT)
+
+    return (frequencies, offsets, 20 * numpy.log10(numpy.abs(power)))
+
+
+def band_limit_factor(sample_rate, params):
+    """
+    The largest decimation factor that keeps MaxFreq (plus a margin for the
+    anti-alias filter roll off) below Nyquist, and divides evenly into the
+    window, overlap and FFT sizes.
+    """
+    if params['max_freq'] <= 0:
+        return 1
+
+    max_factor = int(sample_rate / (2 * params['max_freq'] * BAND_LIMIT_MARGIN))
+    for factor in range(max_factor, 1, -1):
+        if not (params['window_size'] % factor or params['overlap'] % factor
+                or params['nfft'] % factor):
+            return factor
+
+    return 1
+
+
+def display_range(times):
+    # Set range to exact 10 minute mark
+    range_start = times[0]
+    if (pandas.Timestamp(range_start).second > 30):
+        range_start = (range_start + numpy.timedelta64(1, 'm'))
+    range_start = range_start.astype('datetime64[m]')
+
+    range_end = times[-1]
+    range_end = range_end.astype('datetime64[m]')
 
-    # Generate the parameters/data for a spectrogram
-    sample_rate = data.stats['sampling_rate']
-    z_data = data.data
+    return (range_start, range_end)
 
-    spec_info = spectrogram(z_data, sample_rate, window_type, nperseg = window_size,
-                            noverlap = overlap, nfft = NFFT)
 
-    # Convert the times returned from the spectrogram function (0-600 seconds)
-    # to real timestamps to line up with the waveform.
-    spectrograph_times = spec_info[1]
-    DATA_START = data.stats['starttime']
-    spectrograph_times = (spectrograph_times + DATA_START.timestamp).astype('datetime64[s]')
+def gen_station_subplots(times, data, ax1, ax2, spec = None):
+    if spec is None:
+        spec = compute_spectrogram(data)
+
+    frequencies, spectrograph_times, power = spec
 
     # Generate a linear normilization for the spectrogram.
     # Values here are arbitrary, just what happened to work in testing.
-    norm = Normalize(-360, -180)
+    norm = Normalize(NORM_MIN, NORM_MAX)
 
     cm = spectro_map()
 
@@ -84,24 +209,15 @@ def gen_station_subplots(times, data, ax1, ax2):
                               top = True, length = ticklen)
 
     # Plot the waveform
-    ax1.plot(times, z_data, 'k-', linewidth = .5)
+    ax1.plot(times, data.data, 'k-', linewidth = .5)
 
     # And the spectrogram
     ax2.pcolormesh(
-        spectrograph_times, spec_info[0], 20 * numpy.log10(numpy.abs(spec_info[2])),
+        spectrograph_times, frequencies, power,
         norm = norm, cmap = cm, shading = "auto"
     )
 
-    # Set range to exact 10 minute mark
-    range_start = times[0]
-    if (pandas.Timestamp(range_start).second > 30):
-        range_start = (range_start + numpy.timedelta64(1, 'm'))
-    range_start = range_start.astype('datetime64[m]')
-
-    range_end = times[-1]
-    range_end = range_end.astype('datetime64[m]')
-
-    ax2.set_xlim(range_start, range_end)  # Expand x axes to the full requested range
+    ax2.set_xlim(*display_range(times))  # Expand x axes to the full requested range
 
 
 def configure_spectrograph_y(station_label, ax1, ax2):
@@ -122,10 +238,215 @@ def configure_spectrograph_y(station_label, ax1, ax2):
     ax2.yaxis.set_tick_params(direction = "in", right = True)
 
 
-def gen_thumbnail(filename, fig):
+class SpectrographFigure:
+    """
+    A figure with a waveform and spectrogram axes pair for each of a number
+    of stations, laid out once and then reused. Drawing a segment only swaps
+    the waveform line data and the spectrogram image, rather than building a
+    new figure, gridspec and axes and running tight_layout each time.
+
+    Matplotlib figures are not thread safe; hold the lock while using one.
+    """
+
+    def __init__(self, num_stations = 1, thumbnail = False, title = False):
+        plot_height = 1.52 * num_stations + (1 if title else 0)
+        plot_width = 5.76
+        num_plots = 2 * num_stations
+        ratios = [3, 10] * num_stations
+        dpi = 100
+
+        plt.rcParams.update({'font.size': 7})
+
+        self.lock = threading.Lock()
+        # Not a pyplot figure, so it is freed once spectrograph_figure's
+        # cache lets go of it
+        self.fig = Figure(dpi = dpi, figsize = (plot_width, plot_height))
+
+        gs = self.fig.add_gridspec(num_plots, hspace = 0, height_ratios = ratios)
+        self.axes = numpy.atleast_1d(gs.subplots(sharex = True))
+
+        # Generate a linear normilization for the spectrogram.
+        # Values here are arbitrary, just what happened to work in testing.
+        norm = Normalize(NORM_MIN, NORM_MAX)
+        cm = spectro_map()
+
+        self.title = None
+        if title:
+            self.title = self.axes[0].set_title(" ", fontsize=12, fontweight = 'bold')
+
+        self.lines = []
+        self.images = []
+        for ax1, ax2 in zip(self.axes[::2], self.axes[1::2]):
+            # Placeholder data, so the date converter is set up on the x axis
+            placeholder = numpy.array(['2000-01-01', '2000-01-02'], dtype = 'datetime64[ms]')
+            line, = ax1.plot(placeholder, [0, 0], 'k-', linewidth = .5)
+            image = ax2.imshow(numpy.zeros((1, 1)), aspect = 'auto', origin = 'lower',
+                               interpolation = 'nearest', norm = norm, cmap = cm)
+
+            configure_spectrograph_y("", ax1, ax2)
+            ax1.xaxis.set_tick_params(direction = "in", bottom = True,
+                                      top = True, length = 4)
+            self.lines.append(line)
+            self.images.append(image)
+
+        self.axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))  # Format dates as hour:minute
+
+        if thumbnail:
+            for ax in self.axes:
+                ax.xaxis.set_tick_params(top = False, bottom = False)
+                ax.yaxis.set_tick_params(left = False, right = False)
+                ax.axis("off")
+
+            self.fig.set_size_inches(1.5, .396 * num_stations)
+            self.fig.tight_layout(pad = 0)
+        else:
+            side_padding = 25 / (plot_width * dpi)
+            bottom_padding = 25 / (plot_height * dpi)
+            self.fig.tight_layout(pad = 0, rect = (side_padding, bottom_padding,
+                                                   1 - side_padding, 1))
+
+        self.thumbnail = thumbnail
+
+    def set_title(self, title):
+        self.title.set_text(title)
+
+    def set_station(self, idx, times, data, spec = None):
+        if spec is None:
+            spec = compute_spectrogram(data)
+
+        frequencies, spectrograph_times, power = spec
+        ax1 = self.axes[2 * idx]
+        ax2 = self.axes[2 * idx + 1]
+
+        line = self.lines[idx]
+        line.set_data(times, data.data)
+        line.set_visible(True)
+        ax1.relim()
+        ax1.autoscale_view(scalex = False)
+
+        # Cell edges, the same as pcolormesh "auto" shading would use
+        x_centers = mdates.date2num(spectrograph_times)
+        x_step = (x_centers[-1] - x_centers[0]) / max(len(x_centers) - 1, 1)
+        f_step = (frequencies[-1] - frequencies[0]) / max(len(frequencies) - 1, 1)
+        image = self.images[idx]
+        if power.dtype == numpy.uint8:
+            # Quantized power: look the colors up directly
+            image.set_data(spectro_palette()[color_index(power)])
+        else:
+            image.set_data(power)
+        image.set_extent((x_centers[0] - x_step / 2, x_centers[-1] + x_step / 2,
+                          frequencies[0] - f_step / 2, frequencies[-1] + f_step / 2))
+        image.set_visible(True)
+
+        if not self.thumbnail:
+            ax2.set_ylabel(f"{data.stats['station']}.{data.stats['channel']}")
+
+        self.set_time_range(*display_range(times))  # Expand x axes to the full requested range
+        ax2.set_ylim(config['SPECTROGRAM'].getint('MinFreq', 0),
+                     config['SPECTROGRAM'].getint('MaxFreq', 10))
+
+    def set_station_reduced(self, idx, edges, env_min, env_max, spec, station_label = ""):
+        """
+        Draw a station from data already reduced to (about) one column per
+        pixel: a min/max waveform envelope between the datetime64 column
+        edges, and a spectrogram with one column per envelope column. NaN
+        columns are left blank. Drawing cost doesn't depend on the length of
+        time covered.
+        """
+        frequencies, _, power = spec
+        ax1 = self.axes[2 * idx]
+        ax2 = self.axes[2 * idx + 1]
+
+        # A vertical stroke per column, from its min to its max
+        centers = edges[:-1] + (edges[1:] - edges[:-1]) / 2
+        line = self.lines[idx]
+        line.set_data(numpy.repeat(centers, 2),
+                      numpy.column_stack([env_min, env_max]).ravel())
+        line.set_visible(True)
+        ax1.relim()
+        ax1.autoscale_view(scalex = False)
+
+        x_edges = mdates.date2num(edges[[0, -1]])
+        f_step = (frequencies[-1] - frequencies[0]) / max(len(frequencies) - 1, 1)
+        image = self.images[idx]
+        image.set_data(numpy.ma.masked_invalid(power))
+        image.set_extent((x_edges[0], x_edges[1],
+                          frequencies[0] - f_step / 2, frequencies[-1] + f_step / 2))
+        image.set_visible(True)
+
+        if not self.thumbnail:
+            ax2.set_ylabel(station_label)
+
+        self.set_time_range(edges[0], edges[-1])
+        ax2.set_ylim(config['SPECTROGRAM'].getint('MinFreq', 0),
+                     config['SPECTROGRAM'].getint('MaxFreq', 10))
+
+    def set_time_range(self, start, end):
+        # Shared x axis, so any of the axes will do
+        self.axes[-1].set_xlim(start, end)
+        if end - start > numpy.timedelta64(1, 'D'):
+            time_format = '%m-%d %H:%M'
+        else:
+            time_format = '%H:%M'
+        self.axes[-1].xaxis.set_major_formatter(mdates.DateFormatter(time_format))
+
+    def clear_station(self, idx, station_label = ""):
+        # No data for this station
+        self.lines[idx].set_visible(False)
+        self.images[idx].set_visible(False)
+        if not self.thumbnail:
+            self.axes[2 * idx + 1].set_ylabel(station_label)
+
+    def save(self, fname, **kwargs):
+        if self.thumbnail:
+            kwargs.setdefault('pad_inches', 0)
+        self.fig.savefig(fname, transparent = False, **kwargs)
+
+
+@lru_cache(maxsize = 16)
+def spectrograph_figure(num_stations = 1, thumbnail = False, title = False):
+    """
+    A SpectrographFigure that is built once per process, and reused.
+    """
+    return SpectrographFigure(num_stations, thumbnail, title)
+
+
+def render_thumbnail(filename, times, data, spec = None):
+    # Same as gen_spectrograph followed by gen_thumbnail, on a reused figure
+    figure = spectrograph_figure(thumbnail = True)
+    with figure.lock:
+        figure.set_station(0, times, data, spec)
+        figure.save(thumbnail_path(filename))
+
+
+def encode_thumbnail(times, data, spec = None):
+    # The image render_thumbnail would write, in memory
+    buffer = BytesIO()
+    figure = spectrograph_figure(thumbnail = True)
+    with figure.lock:
+        figure.set_station(0, times, data, spec)
+        figure.save(buffer, format = image_extension()[1:])
+    return buffer.getvalue()
+
+
+def thumbnail_format():
+    # One of png (palette indexed), rgb (truecolor PNG) or webp
+    return config.get('RENDER', 'thumbnailformat', fallback = 'png').lower()
+
+
+def image_extension():
+    # File extension for thumbnails and overview tiles
+    return '.webp' if thumbnail_format() == 'webp' else '.png'
+
+
+def thumbnail_path(filename):
     small_path = list(os.path.split(filename))
-    small_path[-1] = "small_" + small_path[-1]
-    filename = os.path.join(*small_path)
+    small_path[-1] = "small_" + os.path.splitext(small_path[-1])[0] + image_extension()
+    return os.path.join(*small_path)
+
+
+def gen_thumbnail(filename, fig):
+    filename = thumbnail_path(filename)
     axes = fig.axes
     for ax in axes:
         ax.xaxis.set_tick_params(top = False, bottom = False)
@@ -0,0 +1,274 @@
+"""
+Coarse overview tiles for browsing long time spans.
+
+Each station gets a pyramid of thumbnail sized tiles: hourly tiles built
+from the stored spectra and waveform segments of the 10 minute windows, and
+daily tiles built from the hourly ones. Alongside each tile image, the
+reduced data it was drawn from (mean power per pixel column on a fixed
+frequency grid, plus a min/max waveform envelope) is saved, so the next
+level up never has to go back to the full resolution data.
+
+Tiles are named by their start time, prefixed with the level name:
+
+    <plotdir>/<STA>/<year>/<month>/<day>/1h_20230101T010000.png
+
+(or .webp, following the RENDER/ThumbnailFormat setting).
+"""
+import fcntl
+import os
+import zipfile
+
+from contextlib import contextmanager
+
+import numpy
+
+from obspy import UTCDateTime
+
+from . import raster, segment, spectra
+from .colormap import spectro_palette
+from .config import config
+from .graphing import image_extension
+from .workqueue import shared_db_path
+
+# (name, seconds) from finest to coarsest. Each level is built from the one
+# before it, the first from the individual image windows.
+LEVELS = (('1h', 3600), ('1d', 86400))
+
+# Number of frequency rows stored for each tile
+FREQ_ROWS = 64
+
+
+def enabled():
+    return config.getboolean('OVERVIEW', 'enabled', fallback = True)
+
+
+def plot_file(img_base, station, when, filename):
+    return os.path.join(img_base, station, str(when.year), str(when.month),
+                        str(when.day), filename)
+
+
+def tile_path(img_base, station, level, start):
+    return plot_file(img_base, station, start,
+                     f"{level}_{start.strftime('%Y%m%dT%H%M%S')}{image_extension()}")
+
+
+def frequency_grid(rows = FREQ_ROWS):
+    min_freq = config['SPECTROGRAM'].getint('MinFreq', 0)
+    max_freq = config['SPECTROGRAM'].getint('MaxFreq', 10)
+    step = (max_freq - min_freq) / rows
+    return min_freq + (numpy.arange(rows) + .5) * step
+
+
+class Tile:
+    """
+    Accumulates reduced spectra and waveform envelopes into fixed pixel
+    columns between start and start + seconds.
+    """
+    def __init__(self, start, seconds, width = raster.THUMB_WIDTH, rows = FREQ_ROWS):
+        self.start = start
+        self.edges = numpy.linspace(start.timestamp, start.timestamp + seconds, width + 1)
+        self.frequencies = frequency_grid(rows)
+        self.power = numpy.zeros((rows, width))
+        self.weight = numpy.zeros(width)
+        self.env_min = numpy.full(width, numpy.nan)
+        self.env_max = numpy.full(width, numpy.nan)
+
+    def centers(self):
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def _columns(self, col_times):
+        idx = numpy.searchsorted(self.edges, col_times, side = 'right') - 1
+        in_tile = (idx >= 0) & (idx < len(self.weight))
+        return (idx[in_tile], in_tile)
+
+    def add_spectra(self, col_times, power, weight = None):
+        # power is on the tile frequency grid, one column per col_times
+        if weight is None:
+            weight = numpy.ones(len(col_times))
+
+        idx, in_tile = self._columns(col_times)
+        weight = weight[in_tile]
+        power = numpy.nan_to_num(power[:, in_tile], nan = 0, posinf = 0, neginf = 0)
+        numpy.add.at(self.power, (slice(None), idx), power * weight)
+        numpy.add.at(self.weight, idx, weight)
+
+    def add_envelope(self, col_times, col_min, col_max):
+        idx, in_tile = self._columns(col_times)
+        numpy.fmin.at(self.env_min, idx, col_min[in_tile])
+        numpy.fmax.at(self.env_max, idx, col_max[in_tile])
+
+    def _add_window_spectra(self, spec, weight = 1):
+        # Regrid a window's spectrogram onto the tile frequencies (nearest bin)
+        frequencies, spec_times, power = spec
+        if len(spec_times) and len(frequencies):
+            rows = numpy.clip(numpy.searchsorted(frequencies, self.frequencies),
+                              0, len(frequencies) - 1)
+            self.add_spectra(raster._seconds(spec_times), power[rows],
+                             numpy.full(len(spec_times), float(weight)))
+
+    def add_window(self, times, data, spec):
+        # One full resolution image window. The waveform envelope is taken
+        # directly at the tile's pixel columns.
+        self._add_window_spectra(spec)
+
+        col_min, col_max = raster.waveform_envelope(times, data, self.edges)
+        self.env_min = numpy.fmin(self.env_min, col_min)
+        self.env_max = numpy.fmax(self.env_max, col_max)
+
+    def add_reduced_window(self, reduced):
+        # A compacted window, as loaded by spectra.load_reduced
+        self._add_window_spectra(reduced['spec'], reduced['decimation'])
+        edges = reduced['edges']
+        self.add_envelope((edges[:-1] + edges[1:]) / 2, reduced['env_min'], reduced['env_max'])
+
+    def add_tile(self, stored):
+        # A finer level tile, as loaded by load()
+        centers = (stored['edges'][:-1] + stored['edges'][1:]) / 2
+        has_data = stored['weight'] > 0
+
+        # Nearest stored frequency row for each of ours
+        power = stored['power']
+        stored_frequencies = frequency_grid(len(power))
+        rows = numpy.clip(numpy.searchsorted(stored_frequencies, self.frequencies),
+                          0, len(power) - 1)
+        self.add_spectra(centers[has_data], power[rows][:, has_data],
+                         stored['weight'][has_data])
+        self.add_envelope(centers, stored['env_min'], stored['env_max'])
+
+    def mean_power(self):
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.power / self.weight
+
+    def empty(self):
+        return not self.weight.any() and numpy.isnan(self.env_min).all()
+
+    def render(self, height = raster.THUMB_HEIGHT):
+        palette = spectro_palette()
+        WHITE = len(palette) - 2
+
+        times = (self.centers() * 1000).astype('datetime64[ms]')
+        spec = (self.frequencies, times, self.mean_power())
+
+        wave_height = int(round(height * raster.RATIOS[0] / sum(raster.RATIOS)))
+        spec_image = raster.render_spectrogram(spec, self.edges, height - wave_height)
+        spec_image[:, self.weight == 0] = WHITE
+
+        return numpy.vstack([
+            raster.render_envelope(self.env_min, self.env_max, wave_height),
+            spec_image,
+        ])
+
+    def save(self, filename):
+        # Both files are replaced whole, so the web app never reads one
+        # half written (tiles are rebuilt as late data arrives)
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        data_path = spectra.spectra_path(filename)
+        tmp_path = f"{data_path}.tmp"
+        with open(tmp_path, 'wb') as data_file:
+            numpy.savez(data_file, params = spectra.params_key(), edges = self.edges,
+                        power = self.mean_power().astype(numpy.float32),
+                        weight = self.weight, env_min = self.env_min, env_max = self.env_max)
+        os.replace(tmp_path, data_path)
+        raster.write_image(filename, self.render())
+
+
+def load(filename):
+    # The stored data for a tile, or None if missing or out of date
+    try:
+        with numpy.load(spectra.spectra_path(filename)) as stored:
+            if str(stored['params']) != spectra.params_key():
+                return None
+            return {key: stored[key] for key in
+                    ('edges', 'power', 'weight', 'env_min', 'env_max')}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def add_windows(tile, img_base, station, start, end):
+    # Add the full resolution image windows overlapping start..end
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    window_end = UTCDateTime(start.timestamp // interval * interval) + interval
+    while window_end < end + interval:
+        filename = plot_file(img_base, station, window_end,
+                             window_end.strftime('%Y%m%dT%H%M%S') + ".png")
+        window_end += interval
+
+        try:
+            times, data = segment.load(filename)
+        except FileNotFoundError:
+            # Compacted windows only have decimated spectra and an envelope
+            reduced = spectra.load_reduced(filename)
+            if reduced is not None:
+                tile.add_reduced_window(reduced)
+            continue
+
+        spec = spectra.load(filename)
+        if spec is None:
+            continue
+        tile.add_window(times, data.data, spec)
+
+
+def add_tiles(tile, img_base, station, level_idx, start, end):
+    # Add the stored tiles of the given level overlapping start..end
+    level, seconds = LEVELS[level_idx]
+    tile_start = start.timestamp // seconds * seconds
+    while tile_start < end.timestamp:
+        stored = load(tile_path(img_base, station, level, UTCDateTime(tile_start)))
+        if stored is not None:
+            tile.add_tile(stored)
+        tile_start += seconds
+
+
+def build_tile(img_base, station, level_idx, start):
+    level, seconds = LEVELS[level_idx]
+    tile = Tile(start, seconds)
+
+    if level_idx == 0:
+        add_windows(tile, img_base, station, start, start + seconds)
+    else:
+        add_tiles(tile, img_base, station, level_idx - 1, start, start + seconds)
+
+    if not tile.empty():
+        tile.save(tile_path(img_base, station, level, start))
+
+
+def assemble(img_base, station, start, end, width, rows = FREQ_ROWS):
+    """
+    Stitch the stored data for start..end into a Tile of the given size,
+    from the coarsest level that still has at least one column per pixel.
+    """
+    tile = Tile(start, end - start, width, rows)
+    column_seconds = (end - start) / width
+
+    for level_idx in reversed(range(len(LEVELS))):
+        if column_seconds >= LEVELS[level_idx][1] / raster.THUMB_WIDTH:
+            add_tiles(tile, img_base, station, level_idx, start, end)
+            return tile
+
+    add_windows(tile, img_base, station, start, end)
+    return tile
+
+
+@contextmanager
+def station_lock(station):
+    # Two workers updating the same tile would each drop the other's windows.
+    # Next to the shared DB, as the workers may be on different hosts.
+    lock_dir = os.path.join(os.path.dirname(shared_db_path()), 'overview')
+    os.makedirs(lock_dir, exist_ok = True)
+    with open(os.path.join(lock_dir, f"{station}.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def update(img_base, station, window_starts):
+    """
+    Rebuild every overview tile (at all levels) that contains one of the
+    given image windows.
+    """
+    with station_lock(station):
+        # As timestamps, since UTCDateTime isn't hashable
+        starts = {start.timestamp for start in window_starts}
+        for level_idx, (_, seconds) in enumerate(LEVELS):
+            starts = {start // seconds * seconds for start in starts}
+            for start in sorted(starts):
+                build_tile(img_base, station, level_idx, UTCDateTime(start))
@@ -0,0 +1,312 @@
+"""
+Per station-day containers for the 10 minute window files.
+
+Rather than a segment, spectra and thumbnail file per station per window, the
+files for a station-day can be appended to a single container in the day
+directory (STORAGE/Pack):
+
+    8 bytes     magic (SPECPAK1)
+
+followed by any number of appends, each of:
+
+    files       the file contents, each starting on a 64 byte boundary, so
+                raw segment samples can still be memory mapped
+    index       JSON: {"prev": <end of the previous append>,
+                       "members": {<file name>: [offset, length], ...}}
+    trailer     magic (SPECIDX1), little-endian uint64 index offset and
+                uint64 index length
+
+Containers are only ever appended to, until the retention job rewrites them
+whole (see rewrite). A regenerated window is appended again, and the newest
+copy wins. Each append is a single write made under an
+exclusive lock, and the trailer at the very end of the file points at the
+newest index, whose "prev" leads back through the older ones. Readers follow
+that chain once, and after that only read what has been appended since.
+
+Files keep the names they would have had as loose files (e.g.
+small_20230101T001000.png). Everything that reads window files goes through
+find/read/exists here, so loose files (written with packing off, or by older
+versions) and packed ones can be mixed. A loose file takes precedence over a
+packed copy.
+"""
+import fcntl
+import json
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .config import config
+
+MAGIC = b'SPECPAK1'
+INDEX_MAGIC = b'SPECIDX1'
+TRAILER = struct.Struct('<8sQQ')
+ALIGNMENT = 64
+PACK_NAME = 'day.pack'
+
+# Indexes of recently used containers, by path
+MAX_CACHED = 256
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+class PackFormatError(Exception):
+    pass
+
+
+def enabled():
+    return config.getboolean('STORAGE', 'pack', fallback = False)
+
+
+def pack_path(filename):
+    # The container for the directory a window file would be in
+    return os.path.join(os.path.dirname(filename), PACK_NAME)
+
+
+def _read_index_at(pack_file, end):
+    # The index of the append ending at end
+    pack_file.seek(end - TRAILER.size)
+    try:
+        magic, index_offset, index_len = TRAILER.unpack(pack_file.read(TRAILER.size))
+        if magic != INDEX_MAGIC or index_offset + index_len + TRAILER.size != end:
+            raise PackFormatError(f"No index ending at {end}")
+
+        pack_file.seek(index_offset)
+        index = json.loads(pack_file.read(index_len))
+        if not len(MAGIC) <= index['prev'] <= index_offset:
+            raise PackFormatError(f"Bad index ending at {end}")
+        return index
+    except (struct.error, ValueError, KeyError, TypeError) as e:
+        raise PackFormatError(f"Bad index ending at {end}") from e
+
+
+def _last_good_end(pack_file, end):
+    """
+    The end of the last complete append at or before end, for when the file
+    ends part way through an append (a crashed writer, or one still writing).
+    """
+    block = 1 << 20
+    pos = end
+    while pos > len(MAGIC):
+        start = max(len(MAGIC), pos - block)
+        pack_file.seek(start)
+        # Overlap the next block, in case a trailer straddles the boundary
+        data = pack_file.read(min(end, pos + TRAILER.size) - start)
+        hit = data.rfind(INDEX_MAGIC)
+        while hit >= 0:
+            candidate = start + hit + TRAILER.size
+            if candidate <= end:
+                try:
+                    _read_index_at(pack_file, candidate)
+                    return candidate
+                except PackFormatError:
+                    pass
+            hit = data.rfind(INDEX_MAGIC, 0, hit)
+        pos = start
+
+    return len(MAGIC)
+
+
+def _read_members(pack_file, end, known_end = len(MAGIC), known = None):
+    # Follow the chain of indexes back from end to known_end, newest first
+    members = {}
+    while end > known_end:
+        index = _read_index_at(pack_file, end)
+        for name, (offset, length) in index['members'].items():
+            members.setdefault(name, (offset, length))
+        end = index['prev']
+
+    if end != known_end:
+        raise PackFormatError("Index chain does not lead back to the known end")
+
+    return {**(known or {}), **members}
+
+
+def index(path):
+    """
+    The files in a container, as {name: (offset, length)}. Empty if there is
+    no container.
+    """
+    try:
+        with open(path, 'rb') as pack_file:
+            stat = os.fstat(pack_file.fileno())
+            end = stat.st_size
+            if end < len(MAGIC) + TRAILER.size:
+                return {}
+
+            with _indexes_lock:
+                cached = _indexes.get(path)
+            if cached is not None and cached[0] == stat.st_ino and cached[1] == end:
+                return cached[2]
+
+            try:
+                if cached is not None and cached[0] == stat.st_ino and cached[1] < end:
+                    members = _read_members(pack_file, end, cached[1], cached[2])
+                else:
+                    members = _read_members(pack_file, end)
+            except PackFormatError:
+                end = _last_good_end(pack_file, end)
+                members = _read_members(pack_file, end)
+    except FileNotFoundError:
+        return {}
+
+    with _indexes_lock:
+        _indexes[path] = (stat.st_ino, end, members)
+        _indexes.move_to_end(path)
+        while len(_indexes) > MAX_CACHED:
+            _indexes.popitem(last = False)
+
+    return members
+
+
+def find(filename):
+    """
+    Where a packed window file is, as (container path, offset, length), or
+    None if it isn't in the container.
+    """
+    path = pack_path(filename)
+    entry = index(path).get(os.path.basename(filename))
+    if entry is None:
+        return None
+    return (path, entry[0], entry[1])
+
+
+def read(filename):
+    """
+    The contents of a window file, loose or packed. Raises FileNotFoundError
+    if it is neither.
+    """
+    try:
+        with open(filename, 'rb') as loose_file:
+            return loose_file.read()
+    except FileNotFoundError:
+        found = find(filename)
+        if found is None:
+            raise
+
+    path, offset, length = found
+    with open(path, 'rb') as pack_file:
+        pack_file.seek(offset)
+        return pack_file.read(length)
+
+
+def exists(filename):
+    return os.path.exists(filename) or find(filename) is not None
+
+
+def version(filename):
+    """
+    Something that changes whenever a window file does, for cache keys: the
+    modification time and size of a loose file, or the container and
+    position of a packed one (appends always land somewhere new, and a
+    rewritten container is a new file). None if there is no file.
+    """
+    try:
+        stat = os.stat(filename)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        found = find(filename)
+        if found is None:
+            return None
+        try:
+            return (os.stat(found[0]).st_ino, found[1], found[2])
+        except FileNotFoundError:
+            return None
+
+
+@contextmanager
+def lock(directory):
+    """
+    Hold the exclusive lock on the container for a directory (creating an
+    empty one if need be), as append does while writing. Anything waiting on
+    the lock when the container is replaced (see rewrite) moves on to the new
+    file.
+    """
+    path = os.path.join(directory, PACK_NAME)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _encode(files, end):
+    # An append of [(filename, data), ...] to a container that ends at end
+    chunks = []
+    if end == 0:
+        chunks.append(MAGIC)
+        end = len(MAGIC)
+
+    offset = end
+    members = {}
+    for filename, data in files:
+        padding = -offset % ALIGNMENT
+        chunks.append(b'\0' * padding)
+        offset += padding
+        members[os.path.basename(filename)] = [offset, len(data)]
+        chunks.append(data)
+        offset += len(data)
+
+    index_data = json.dumps({'prev': end, 'members': members}).encode()
+    chunks.append(index_data)
+    chunks.append(TRAILER.pack(INDEX_MAGIC, offset, len(index_data)))
+    return b''.join(chunks)
+
+
+def append(files):
+    """
+    Add [(filename, data), ...], all in the same directory, to the container
+    for that directory in a single write. Loose copies of the files are
+    removed, so that the new data is what gets read.
+    """
+    path = pack_path(files[0][0])
+    with lock(os.path.dirname(path)) as fd:
+        end = os.fstat(fd).st_size
+        if end < len(MAGIC) + TRAILER.size:
+            # New (or never completed) container
+            end = 0
+        else:
+            with open(path, 'rb') as pack_file:
+                try:
+                    _read_index_at(pack_file, end)
+                except PackFormatError:
+                    # Drop whatever a crashed writer left behind
+                    end = _last_good_end(pack_file, end)
+
+        os.ftruncate(fd, end)
+        os.pwrite(fd, _encode(files, end), end)
+
+    for filename, _ in files:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def rewrite(directory, files):
+    """
+    Replace the container for a directory with one holding just the given
+    [(filename, data), ...], dropping everything else it had, including
+    superseded copies. The caller should hold the lock (see lock), so that
+    no append is lost.
+    """
+    path = os.path.join(directory, PACK_NAME)
+    if not files:
+        os.remove(path)
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as pack_file:
+        pack_file.write(_encode(files, 0))
+    os.replace(tmp_path, path)
@@ -0,0 +1,53 @@
+"""
+Minimal PNG writer for images we build ourselves as numpy arrays.
+"""
+import struct
+import zlib
+
+import numpy
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data
+            + struct.pack('>I', zlib.crc32(tag + data)))
+
+
+def encode_png(pixels, palette = None, level = 6):
+    """
+    Encode an image as PNG bytes.
+
+    pixels is either a (height, width, 3) uint8 RGB array, or a (height, width)
+    uint8 array of indexes into palette, an (N, 3) uint8 array of RGB colors.
+    """
+    pixels = numpy.ascontiguousarray(pixels, dtype = numpy.uint8)
+    height, width = pixels.shape[:2]
+
+    if palette is None:
+        color_type = 2  # truecolor RGB
+        rows = pixels.reshape(height, width * 3)
+    else:
+        color_type = 3  # palette indexed
+        rows = pixels
+
+    # Each row is prefixed by its filter type. We don't filter (type 0).
+    raw = numpy.empty((height, rows.shape[1] + 1), dtype = numpy.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = rows
+
+    header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+
+    chunks = [PNG_SIGNATURE, _chunk(b'IHDR', header)]
+    if palette is not None:
+        palette = numpy.ascontiguousarray(palette, dtype = numpy.uint8)
+        chunks.append(_chunk(b'PLTE', palette.tobytes()))
+    chunks.append(_chunk(b'IDAT', zlib.compress(raw.tobytes(), level)))
+    chunks.append(_chunk(b'IEND', b''))
+
+    return b''.join(chunks)
+
+
+def write_png(filename, pixels, palette = None, level = 6):
+    with open(filename, 'wb') as png_file:
+        png_file.write(encode_png(pixels, palette, level))
@@ -0,0 +1,305 @@
+"""
+Tiered retention for the plot archive.
+
+Each station-day directory moves through three tiers as it ages:
+
+    full       everything the generator wrote, for RETENTION/FullDays
+    compacted  the thumbnails, plus the spectrogram decimated in time
+               (RETENTION/Decimate) and a one second min/max waveform
+               envelope in place of the waveform, all in a freshly written
+               station-day container (see pack)
+    dropped    deleted, along with its availability records, once older
+               than RETENTION/KeepMonths (0 keeps compacted days forever)
+
+Compacted windows keep their file names, so thumbnail URLs still work, the
+full image view draws them from the reduced data, and overview tiles can
+still be rebuilt from them. Their availability status is unchanged.
+
+Station-days are processed independently over a process pool. The tier each
+was left in is recorded in the cache DB, along with the modification times
+of the directory and its container, so a run only revisits days that have
+aged into a new tier or been written to since. Compacting a day can safely
+be repeated, so an interrupted run can simply be run again.
+
+    python run_retention.py
+"""
+import argparse
+import calendar
+import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import numpy
+
+from obspy import UTCDateTime
+
+from . import availability, generate, graphing, pack, raster, segment, spectra
+from .config import config
+
+# Files written for each window, by window end time
+WINDOW_FILE = re.compile(r'^(small_)?(\d{8}T\d{6})\.(seg|npz|pbz2|png|webp)$')
+
+ENVELOPE_COLUMNS = 600
+
+
+def months_before(day, months):
+    month_idx = day.year * 12 + day.month - 1 - months
+    year, month = divmod(month_idx, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def tier(day, today, full_days, keep_months):
+    if keep_months and day < months_before(today, keep_months):
+        return 'dropped'
+    if day < today - timedelta(days = full_days):
+        return 'compacted'
+    return 'full'
+
+
+def _subdirs(path, numeric = True):
+    try:
+        entries = [entry for entry in os.scandir(path) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+    if numeric:
+        entries = [entry for entry in entries if entry.name.isdigit()]
+    return sorted(entries, key = lambda entry: entry.name)
+
+
+def station_days(img_base):
+    # (station, date, directory) for each day directory in the archive
+    for sta_dir in _subdirs(img_base, numeric = False):
+        for year_dir in _subdirs(sta_dir.path):
+            for month_dir in _subdirs(year_dir.path):
+                for day_dir in _subdirs(month_dir.path):
+                    try:
+                        day = date(int(year_dir.name), int(month_dir.name), int(day_dir.name))
+                    except ValueError:
+                        continue
+                    yield (sta_dir.name, day, day_dir.path)
+
+
+def signature(day_dir):
+    # Changes whenever a file in the directory is added, replaced or removed,
+    # or the container is appended to
+    parts = [os.stat(day_dir).st_mtime_ns]
+    try:
+        parts.append(os.stat(os.path.join(day_dir, pack.PACK_NAME)).st_mtime_ns)
+    except FileNotFoundError:
+        parts.append(None)
+    return json.dumps(parts)
+
+
+def init_db(cache_db):
+    with sqlite3.connect(cache_db) as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS retention (
+            station TEXT,
+            day TEXT,
+            tier TEXT,
+            signature TEXT,
+            completed TEXT,
+            PRIMARY KEY (station, day)
+        )""")
+
+
+def processed_days(cache_db):
+    with sqlite3.connect(cache_db) as conn:
+        cur = conn.execute("SELECT station, day, tier, signature FROM retention")
+        return {(station, day): (day_tier, day_signature)
+                for station, day, day_tier, day_signature in cur}
+
+
+def mark_processed(cache_db, station, day, day_tier, day_signature):
+    with sqlite3.connect(cache_db) as conn:
+        conn.execute("""INSERT OR REPLACE INTO retention
+                        (station, day, tier, signature, completed)
+                        VALUES (?,?,?,?,?)""",
+                     (station, day.isoformat(), day_tier, day_signature,
+                      UTCDateTime().isoformat()))
+        conn.commit()
+
+
+def reduce_window(filename, end, factor):
+    """
+    The spectra file for a compacted window, or None if the window has
+    neither a stored spectrogram nor a waveform to compute one from.
+    """
+    if spectra.load_reduced(filename) is not None:
+        return pack.read(spectra.spectra_path(filename))  # Already compacted
+
+    try:
+        times, data = segment.load(filename)
+    except FileNotFoundError:
+        times = data = None
+
+    spec = spectra.load(filename)
+    if spec is None:
+        if data is None:
+            return None
+        spec = graphing.compute_spectrograms([data])[0]
+
+    interval = config['GLOBAL'].getint('minutesperimage', 10) * 60
+    edges = numpy.linspace(end.timestamp - interval, end.timestamp, ENVELOPE_COLUMNS + 1)
+    if data is None:
+        env_min = env_max = numpy.full(ENVELOPE_COLUMNS, numpy.nan)
+    else:
+        env_min, env_max = raster.waveform_envelope(times, data.data, edges)
+
+    return spectra.encode_reduced(spec, edges, env_min, env_max, factor)
+
+
+def compact_day(day_dir, factor):
+    """
+    Rewrite a day directory as a container holding just the thumbnails and
+    reduced spectra of each window. Returns (windows, bytes before, bytes
+    after).
+    """
+    container = os.path.join(day_dir, pack.PACK_NAME)
+    with pack.lock(day_dir):
+        loose = {}
+        windows = {}
+        for entry in os.scandir(day_dir):
+            match = WINDOW_FILE.match(entry.name)
+            if match and entry.is_file():
+                loose[entry.path] = entry.stat()
+                windows.setdefault(match.group(2), set()).add(entry.name)
+        for name in pack.index(container):
+            match = WINDOW_FILE.match(name)
+            if match:
+                windows.setdefault(match.group(2), set()).add(name)
+
+        size_before = os.path.getsize(container) + sum(stat.st_size for stat in loose.values())
+
+        files = []
+        for stamp in sorted(windows):
+            for name in sorted(windows[stamp]):
+                if name.startswith('small_'):
+                    path = os.path.join(day_dir, name)
+                    files.append((path, pack.read(path)))
+
+            filename = os.path.join(day_dir, f"{stamp}.png")
+            end = UTCDateTime(datetime.strptime(stamp, '%Y%m%dT%H%M%S'))
+            reduced = reduce_window(filename, end, factor)
+            if reduced is not None:
+                files.append((spectra.spectra_path(filename), reduced))
+
+        pack.rewrite(day_dir, files)
+
+        # Everything is in the container now. Leave any loose file that was
+        # rewritten in the meantime, so the newer data isn't lost.
+        for path, stat in loose.items():
+            try:
+                if os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    size_after = os.path.getsize(container) if files else 0
+    return (len(windows), size_before, size_after)
+
+
+def drop_day(cache_db, station, day, day_dir):
+    # Availability first, so an interruption can't leave records of files
+    # that are gone
+    availability.forget(cache_db, station, UTCDateTime(day),
+                        UTCDateTime(day + timedelta(days = 1)))
+    shutil.rmtree(day_dir)
+
+    # Tidy up the month and year directories, if now empty
+    parent = os.path.dirname(day_dir)
+    for _ in range(2):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def process_day(cache_db, station, day, day_dir, day_tier, factor):
+    """
+    Bring one station-day down to the given tier. Returns (signature,
+    windows, bytes before, bytes after).
+    """
+    if day_tier == 'dropped':
+        size = sum(entry.stat().st_size for entry in os.scandir(day_dir) if entry.is_file())
+        drop_day(cache_db, station, day, day_dir)
+        return (None, None, size, 0)
+
+    windows, size_before, size_after = compact_day(day_dir, factor)
+    return (signature(day_dir), windows, size_before, size_after)
+
+
+def retention(workers = None, dry_run = False, today = None):
+    full_days = config.getint('RETENTION', 'fulldays', fallback = 30)
+    keep_months = config.getint('RETENTION', 'keepmonths', fallback = 0)
+    factor = config.getint('RETENTION', 'decimate', fallback = 4)
+    if today is None:
+        today = datetime.utcnow().date()
+
+    cache_db = generate.cache_db_path()
+    init_db(cache_db)
+    processed = processed_days(cache_db)
+
+    work = []
+    for station, day, day_dir in station_days(generate.plot_dir()):
+        day_tier = tier(day, today, full_days, keep_months)
+        if day_tier == 'full':
+            continue
+        if processed.get((station, day.isoformat())) == (day_tier, signature(day_dir)):
+            continue
+        work.append((station, day, day_dir, day_tier))
+
+    print("Retention:", sum(item[3] == 'compacted' for item in work), "station-days to compact,",
+          sum(item[3] == 'dropped' for item in work), "to drop")
+    if dry_run:
+        for station, day, _, day_tier in work:
+            print("   ", station, day, day_tier)
+        return {}
+
+    totals = {'compacted': 0, 'dropped': 0, 'failed': 0, 'bytes_before': 0, 'bytes_after': 0}
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = {
+            executor.submit(process_day, cache_db, station, day, day_dir, day_tier, factor):
+                (station, day, day_tier)
+            for station, day, day_dir, day_tier in work
+        }
+
+        for future in as_completed(futures):
+            station, day, day_tier = futures[future]
+            try:
+                day_signature, _, size_before, size_after = future.result()
+            except Exception as e:
+                print("Retention failed for", station, day, e)
+                totals['failed'] += 1
+                continue
+
+            totals[day_tier] += 1
+            totals['bytes_before'] += size_before
+            totals['bytes_after'] += size_after
+            if day_tier == 'compacted':
+                mark_processed(cache_db, station, day, day_tier, day_signature)
+
+    return totals
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Compact and expire old plot archive data")
+    parser.add_argument('--workers', type = int, help = "Number of worker processes")
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = "List the station-days that would be processed, and stop")
+    args = parser.parse_args(argv)
+
+    t1 = time.time()
+    totals = retention(args.workers, args.dry_run)
+    print("Retention complete in", time.time() - t1, totals)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Compact on-disk storage for segment waveform data.
+
+Each segment is stored in a single .seg file:
+
+    8 bytes     magic (SPECSEG1)
+    4 bytes     little-endian uint32 header length
+    header      JSON metadata (SCNL, start time, sample rate, npts, dtype,
+                codec), padded so the samples start on a 64 byte boundary
+    samples     little-endian int32 or float32 samples
+
+Sample times are not stored; they are implied by the start time and sample
+rate. With the default "raw" codec the samples can be memory mapped, so
+reading a file (or just a time slice of it) doesn't copy any data. The "zlib"
+codec trades that for smaller files.
+
+Segment files may also be kept in the station-day containers (see pack).
+Segments written by older versions as bz2 pickles (.pbz2) can still be read.
+"""
+import bz2
+import json
+import os
+import pickle
+import struct
+import zlib
+
+import numpy
+
+from obspy import Trace, UTCDateTime
+
+from . import pack
+from .config import config
+
+MAGIC = b'SPECSEG1'
+ALIGNMENT = 64
+EXTENSION = '.seg'
+LEGACY_EXTENSION = '.pbz2'
+
+
+class SegmentFormatError(Exception):
+    pass
+
+
+class Segment:
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+
+    @property
+    def starttime(self):
+        return UTCDateTime(self.header['starttime'])
+
+    @property
+    def sampling_rate(self):
+        return self.header['sampling_rate']
+
+    @property
+    def npts(self):
+        return len(self.data)
+
+    @property
+    def endtime(self):
+        return self.starttime + (self.npts - 1) / self.sampling_rate
+
+    def times(self):
+        # Sample times as datetime64[ms], the same as waveform.prepare makes
+        offsets = numpy.arange(self.npts) * (1000 / self.sampling_rate)
+        start = numpy.datetime64(round(self.header['starttime'] * 1000), 'ms')
+        return start + offsets.astype('timedelta64[ms]')
+
+    def slice(self, starttime = None, endtime = None):
+        """
+        Return a new Segment covering just the given time range. The data is
+        a view on this segment's data, not a copy.
+        """
+        first = 0
+        last = self.npts
+        if starttime is not None:
+            first = int(numpy.ceil((UTCDateTime(starttime) - self.starttime) * self.sampling_rate))
+            first = min(max(first, 0), self.npts)
+        if endtime is not None:
+            last = int(numpy.floor((UTCDateTime(endtime) - self.starttime) * self.sampling_rate)) + 1
+            last = min(max(last, first), self.npts)
+
+        header = dict(self.header)
+        header['starttime'] = self.header['starttime'] + first / self.sampling_rate
+        return Segment(header, self.data[first:last])
+
+    def to_trace(self):
+        header = {key: self.header[key] for key in
+                  ('network', 'station', 'location', 'channel', 'sampling_rate')}
+        header['starttime'] = self.starttime
+        return Trace(data = self.data, header = header)
+
+
+def segment_path(filename):
+    # Same name as the image, with the segment extension
+    return os.path.splitext(filename)[0] + EXTENSION
+
+
+def _sample_dtype(data):
+    if numpy.issubdtype(data.dtype, numpy.integer):
+        info = numpy.iinfo(numpy.int32)
+        if data.size == 0 or (data.min() >= info.min and data.max() <= info.max):
+            return numpy.dtype('<i4')
+
+    return numpy.dtype('<f4')
+
+
+def encode(trace, codec = None, level = None):
+    """
+    The contents of a segment file for an ObsPy trace. codec and level
+    default to the STORAGE/Codec and STORAGE/Level config settings.
+    """
+    if codec is None:
+        codec = config.get('STORAGE', 'codec', fallback = 'raw')
+    if level is None:
+        level = config.getint('STORAGE', 'level', fallback = 1)
+
+    data = numpy.ma.filled(trace.data, 0) if numpy.ma.isMaskedArray(trace.data) else trace.data
+    dtype = _sample_dtype(data)
+    payload = numpy.ascontiguousarray(data, dtype = dtype).tobytes()
+
+    if codec == 'zlib':
+        payload = zlib.compress(payload, level)
+    elif codec != 'raw':
+        raise ValueError(f"Unknown segment codec '{codec}'")
+
+    stats = trace.stats
+    header = {
+        'network': stats.network,
+        'station': stats.station,
+        'location': stats.location,
+        'channel': stats.channel,
+        'starttime': stats.starttime.timestamp,
+        'sampling_rate': stats.sampling_rate,
+        'npts': len(data),
+        'dtype': dtype.str,
+        'codec': codec,
+        'size': len(payload),
+    }
+    header = json.dumps(header).encode()
+
+    # Pad the header with spaces so the samples are aligned for memory mapping
+    prefix_len = len(MAGIC) + 4
+    header += b' ' * (-(prefix_len + len(header)) % ALIGNMENT)
+
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header, payload])
+
+
+def write(filename, trace, codec = None, level = None):
+    # Write an ObsPy trace as a segment file, see encode
+    path = segment_path(filename)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as seg_file:
+        seg_file.write(encode(trace, codec, level))
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def read(filename, mmap = True):
+    """
+    Read a segment file, loose or packed. With mmap (and the raw codec), the
+    samples are memory mapped rather than read in.
+    """
+    path = segment_path(filename)
+    try:
+        seg_file = open(path, 'rb')
+    except FileNotFoundError:
+        found = pack.find(path)
+        if found is None:
+            raise
+        path = found[0]
+        seg_file = open(path, 'rb')
+        seg_file.seek(found[1])
+
+    with seg_file:
+        magic = seg_file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise SegmentFormatError(f"{path} is not a segment file")
+
+        header_len = struct.unpack('<I', seg_file.read(4))[0]
+        header = json.loads(seg_file.read(header_len))
+        offset = seg_file.tell()
+
+        dtype = numpy.dtype(header['dtype'])
+        if header['codec'] == 'raw':
+            if mmap and header['npts']:
+                data = numpy.memmap(path, dtype = dtype, mode = 'r',
+                                    offset = offset, shape = (header['npts'], ))
+            else:
+                data = numpy.fromfile(seg_file, dtype = dtype, count = header['npts'])
+        elif header['codec'] == 'zlib':
+            data = numpy.frombuffer(zlib.decompress(seg_file.read(header['size'])),
+                                    dtype = dtype)
+        else:
+            raise SegmentFormatError(f"Unknown codec {header['codec']} in {path}")
+
+    return Segment(header, data)
+
+
+def load(filename):
+    """
+    Load the waveform data for a segment, returning (times, trace) the same
+    as waveform.prepare does. Falls back to the older .pbz2 format if there
+    is no segment file. Raises FileNotFoundError if neither exists.
+    """
+    try:
+        segment = read(filename)
+    except FileNotFoundError:
+        legacy_path = os.path.splitext(filename)[0] + LEGACY_EXTENSION
+        with bz2.BZ2File(legacy_path, 'r') as figure_file:
+            waveform_times = pickle.load(figure_file)
+            z_data = pickle.load(figure_file)
+        return (waveform_times, z_data)
+
+    return (segment.times(), segment.to_trace())
@@ -0,0 +1,122 @@
+"""
+Handing fetched waveform data to worker processes through shared memory.
+
+The samples of a batch of streams are copied into a single shared memory
+block, and the workers are given just the block name and a small layout
+describing where each trace is, rather than the pickled streams. Workers
+rebuild the streams with their data as views on the block.
+
+The block belongs to the process that made it, which releases it once the
+work using it is done.
+"""
+import sys
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+
+from obspy import Stream, Trace, UTCDateTime
+
+ALIGNMENT = 64
+
+
+def _header(trace):
+    stats = trace.stats
+    return {
+        'network': stats.network,
+        'station': stats.station,
+        'location': stats.location,
+        'channel': stats.channel,
+        'starttime': stats.starttime.timestamp,
+        'sampling_rate': stats.sampling_rate,
+    }
+
+
+def share_streams(streams):
+    """
+    Copy the data of a list of streams (any of which may be None) into a
+    new shared memory block. Returns the block, and a layout per stream (a
+    list of (header, dtype, offset, npts) per trace, or None) for
+    attach_streams.
+    """
+    layouts = []
+    offset = 0
+    for stream in streams:
+        if stream is None:
+            layouts.append(None)
+            continue
+
+        layout = []
+        for trace in stream:
+            offset += -offset % ALIGNMENT
+            data = trace.data
+            layout.append((_header(trace), data.dtype.str, offset, len(data)))
+            offset += data.nbytes
+        layouts.append(layout)
+
+    shm = SharedMemory(create = True, size = max(offset, 1))
+    for stream, layout in zip(streams, layouts):
+        for trace, (_, dtype, trace_offset, npts) in zip(stream or (), layout or ()):
+            target = numpy.ndarray((npts, ), dtype = dtype, buffer = shm.buf,
+                                   offset = trace_offset)
+            target[:] = numpy.ma.filled(trace.data, 0) if numpy.ma.isMaskedArray(trace.data) \
+                else trace.data
+
+    return (shm, layouts)
+
+
+def _attach(name):
+    # Without registering the block with the resource tracker, which would
+    # unlink it when this process exits, or take over the creating process's
+    # registration if the tracker is shared.
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name = name, track = False)
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return SharedMemory(name = name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_streams(name, layouts):
+    """
+    Attach to a block made by share_streams, returning it and the streams
+    it holds. The trace data are views on the block, so must be dropped
+    before detach is called.
+    """
+    shm = _attach(name)
+    streams = []
+    for layout in layouts:
+        if layout is None:
+            streams.append(None)
+            continue
+
+        stream = Stream()
+        for header, dtype, offset, npts in layout:
+            header = dict(header, starttime = UTCDateTime(header['starttime']))
+            data = numpy.ndarray((npts, ), dtype = dtype, buffer = shm.buf, offset = offset)
+            stream.append(Trace(data = data, header = header))
+        streams.append(stream)
+
+    return (shm, streams)
+
+
+def detach(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Something still holds a view on the block. It is unmapped once
+        # that is garbage collected.
+        pass
+
+
+def release(shm):
+    # Free a block made by share_streams
+    detach(shm)
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
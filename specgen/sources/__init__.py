@@ -0,0 +1,113 @@
+"""
+Waveform data sources.
+
+Each source knows how to pull raw waveform data for a station/channel and time
+range. The active source is selected by the WAVEFORM/Source config option, and
+is created once per process so that any connections it holds can be reused
+between requests.
+"""
+from functools import lru_cache
+
+from obspy import Stream, UTCDateTime
+
+from ..config import config
+
+
+def span_coverage(spans, starttime, endtime):
+    """
+    Fraction of starttime..endtime covered by the union of the given
+    (start, end) timestamp spans.
+    """
+    start = UTCDateTime(starttime).timestamp
+    end = UTCDateTime(endtime).timestamp
+    if end <= start:
+        return 0.0
+
+    covered = 0
+    reached = start
+    for span_start, span_end in sorted(spans):
+        span_start = max(span_start, reached)
+        span_end = min(span_end, end)
+        if span_end > span_start:
+            covered += span_end - span_start
+            reached = span_end
+
+    return min(covered / (end - start), 1.0)
+
+
+def stream_spans(stream):
+    # (start, end) timestamps of each trace, including the last sample period
+    return [(trace.stats.starttime.timestamp,
+             trace.stats.endtime.timestamp + trace.stats.delta) for trace in stream]
+
+
+class WaveformSource:
+    def get_waveforms(self, network, station, location, channel,
+                      starttime, endtime):
+        raise NotImplementedError
+
+    def get_waveforms_bulk(self, bulk):
+        # bulk is a list of (network, station, location, channel, starttime, endtime)
+        # tuples. Returns a list of streams in the same order.
+        results = [None] * len(bulk)
+        for idx, stream in self.iter_waveforms_bulk(bulk):
+            results[idx] = stream
+
+        return results
+
+    def _get_waveforms_or_empty(self, request):
+        try:
+            return self.get_waveforms(*request)
+        except Exception as e:
+            print("Unable to retrieve data for", request[1], e)
+            return Stream()
+
+    def iter_waveforms_bulk(self, bulk):
+        # Like get_waveforms_bulk, but yields (index, stream) as each request
+        # completes, so the data can be put to use while the rest is still on
+        # its way. Sources that can do better than one request at a time
+        # should override this.
+        for idx, request in enumerate(bulk):
+            yield (idx, self._get_waveforms_or_empty(request))
+
+    def get_coverage_bulk(self, bulk):
+        # The fraction of each request's time range that the source has data
+        # for. Used to check for late data without processing it, so sources
+        # that can answer more cheaply than fetching everything should.
+        return [span_coverage(stream_spans(stream), request[4], request[5])
+                for request, stream in zip(bulk, self.get_waveforms_bulk(bulk))]
+
+    def close(self):
+        pass
+
+
+def _winston_source():
+    from .winston import WinstonSource
+    return WinstonSource(config['WINSTON']['url'],
+                         config['WINSTON'].getint('port', 16022),
+                         pool_size = config['WINSTON'].getint('poolsize', 8),
+                         timeout = config['WINSTON'].getfloat('timeout', 30))
+
+
+def _sds_source():
+    from .sds import SDSSource
+    return SDSSource(config.get('SDS', 'root'))
+
+
+SOURCES = {
+    'winston': _winston_source,
+    'sds': _sds_source,
+}
+
+
+@lru_cache
+def get_source(name = None):
+    if name is None:
+        name = config.get('WAVEFORM', 'source', fallback = 'winston')
+
+    try:
+        factory = SOURCES[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown waveform source '{name}'") from None
+
+    return factory()
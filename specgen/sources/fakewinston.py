@@ -0,0 +1,142 @@
+"""
+A tiny fake Winston wave server, for testing and offline benchmarking.
+
+Answers MENU and GETSCNLRAW requests with deterministic synthetic data
+(noise plus a couple of tones) for any station/channel asked for. Connections
+are kept open between requests, the same as a real Winston.
+
+Run standalone with:
+
+    python -m specgen.sources.fakewinston --port 16022
+"""
+import argparse
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+import numpy
+
+from .winston import TRACEBUF_HEADER
+
+PACKET_SECONDS = 1
+
+
+def synthetic_data(station, channel, start, npts, rate):
+    # Seed on the SCNL and sample index so that any request for the same
+    # samples gets the same data back, no matter how the time range is split.
+    first = int(round(start * rate))
+    idx = numpy.arange(first, first + npts)
+    seed = zlib.crc32(f"{station}.{channel}".encode())
+    t = idx / rate
+    noise = 400 * ((numpy.sin(idx * 12.9898 + seed % 1000) * 43758.5453) % 1 - .5)
+    tones = 1000 * numpy.sin(2 * numpy.pi * 2.5 * t) + 500 * numpy.sin(2 * numpy.pi * 7 * t)
+    return (noise + tones).astype('<i4')
+
+
+class FakeWinstonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            command, _, args = line.decode().strip().partition(':')
+            args = args.split()
+            if command == 'GETSCNLRAW':
+                self.getscnlraw(*args)
+            elif command == 'MENU':
+                self.wfile.write(f"{args[0] if args else ''} \n".encode())
+            else:
+                self.wfile.write(b"ERROR\n")
+
+            self.wfile.flush()
+
+    def getscnlraw(self, req_id, sta, chan, net, loc, start, end):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        start = float(start)
+        end = float(end)
+        if server.lag:
+            # Data arrives this many seconds behind real time
+            end = min(end, time.time() - server.lag)
+        rate = server.rate
+        if sta in server.missing or end <= start:
+            self.wfile.write(f"{req_id} 0 {sta} {chan} {net} {loc} FR s4\n".encode())
+            return
+
+        first = numpy.ceil(start * rate) / rate
+        npts = int((end - first) * rate) + 1
+        data = synthetic_data(sta, chan, first, npts, rate)
+
+        packets = []
+        step = int(PACKET_SECONDS * rate)
+        for offset in range(0, npts, step):
+            chunk = data[offset:offset + step]
+            pkt_start = first + offset / rate
+            header = struct.pack('<' + TRACEBUF_HEADER, 0, len(chunk), pkt_start,
+                                 pkt_start + (len(chunk) - 1) / rate, rate,
+                                 sta.encode(), net.encode(), chan.encode(),
+                                 loc.encode(), b'20', b'i4', b'\x00\x00', b'\x00\x00')
+            packets.append(header)
+            packets.append(chunk.tobytes())
+
+        payload = b''.join(packets)
+        self.wfile.write(f"{req_id} 0 {sta} {chan} {net} {loc} F i4 "
+                         f"{first:f} {end:f} {len(payload)}\n".encode())
+        self.wfile.write(payload)
+
+
+class FakeWinstonServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host = '127.0.0.1', port = 0, rate = 50.0,
+                 latency = 0, missing = (), lag = 0):
+        super().__init__((host, port), FakeWinstonHandler)
+        self.rate = rate
+        self.latency = latency
+        self.lag = lag
+        self.missing = set(missing)
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run a fake Winston wave server")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 16022)
+    parser.add_argument('--rate', type = float, default = 50.0,
+                        help = "Sample rate of the generated data")
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = "Seconds to wait before answering each request")
+    parser.add_argument('--lag', type = float, default = 0,
+                        help = "Seconds behind real time that data is available, "
+                        "to simulate late data")
+    args = parser.parse_args()
+
+    server = FakeWinstonServer(args.host, args.port, args.rate, args.latency,
+                               lag = args.lag)
+    print("Fake winston listening on", "{}:{}".format(*server.address))
+    server.serve_forever()
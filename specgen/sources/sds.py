@@ -0,0 +1,44 @@
+"""
+Local SDS (SeisComP Data Structure) miniSEED archive source.
+
+Useful for running against archived data, or for benchmarking without a
+network connection to a winston.
+"""
+from obspy import UTCDateTime
+from obspy.clients.filesystem.sds import Client as SDSClient
+
+from . import WaveformSource, span_coverage, stream_spans
+
+
+class SDSSource(WaveformSource):
+    def __init__(self, root):
+        if not root:
+            raise ValueError("No SDS root directory configured")
+
+        self.client = SDSClient(root)
+
+    def get_waveforms(self, network, station, location, channel,
+                      starttime, endtime):
+        # Winston uses -- to mean "no location code", SDS uses an empty string.
+        if location == '--':
+            location = ''
+
+        return self.client.get_waveforms(network, station, location, channel,
+                                         UTCDateTime(starttime),
+                                         UTCDateTime(endtime))
+
+    def get_coverage_bulk(self, bulk):
+        # Only the miniSEED record headers are needed for this
+        results = []
+        for network, station, location, channel, starttime, endtime in bulk:
+            try:
+                stream = self.client.get_waveforms(network, station,
+                                                   '' if location == '--' else location,
+                                                   channel, UTCDateTime(starttime),
+                                                   UTCDateTime(endtime), headonly = True)
+            except Exception as e:
+                print("Unable to retrieve data for", station, e)
+                stream = []
+            results.append(span_coverage(stream_spans(stream), starttime, endtime))
+
+        return results
@@ -0,0 +1,212 @@
+"""
+Winston wave server source.
+
+ObsPy's earthworm client opens a new socket for every request. Winston is happy
+to answer any number of requests on a single connection, so this keeps a small
+pool of open sockets around and spreads bulk requests across them.
+"""
+import queue
+import socket
+import struct
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import numpy
+
+from obspy import Stream, Trace, UTCDateTime
+
+from . import WaveformSource, span_coverage
+
+# Tracebuf2 header: pinno, nsamp, starttime, endtime, samprate, sta, net, chan,
+# loc, version, datatype, quality, pad. Always 64 bytes.
+TRACEBUF_HEADER = '2i3d7s9s4s3s2s3s2s2s'
+TRACEBUF_HEADER_SIZE = struct.calcsize('<' + TRACEBUF_HEADER)
+
+
+class WinstonError(Exception):
+    pass
+
+
+class WinstonSource(WaveformSource):
+    def __init__(self, host, port, pool_size = 8, timeout = 30):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._pool = queue.LifoQueue()
+        self._req_id = 0
+        self._req_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        timeout = self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock.makefile('rwb')
+
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        except Exception:
+            # Don't know what state the connection is in, so don't reuse it.
+            conn.close()
+            raise
+        else:
+            self._pool.put(conn)
+
+    def _next_id(self):
+        with self._req_lock:
+            self._req_id += 1
+            return f"sg{self._req_id}"
+
+    def _request(self, conn, request):
+        conn.write(request.encode())
+        conn.flush()
+
+        header = conn.readline()
+        if not header:
+            raise WinstonError("Connection closed by server")
+
+        tokens = header.decode().split()
+        if len(tokens) < 7 or tokens[6] != 'F':
+            # No data for this channel/time range
+            return b''
+
+        nbytes = int(tokens[-1])
+        payload = conn.read(nbytes)
+        if len(payload) != nbytes:
+            raise WinstonError("Short read from server")
+
+        return payload
+
+    def _get_raw(self, network, station, location, channel, starttime, endtime):
+        if not location:
+            location = '--'
+
+        request = (f"GETSCNLRAW: {self._next_id()} {station} {channel} "
+                   f"{network} {location} {UTCDateTime(starttime).timestamp:f} "
+                   f"{UTCDateTime(endtime).timestamp:f}\n")
+
+        # A pooled connection may have been closed on the server side while
+        # idle, so give it one retry on a fresh connection.
+        for attempt in range(2):
+            try:
+                with self._connection() as conn:
+                    return self._request(conn, request)
+            except (OSError, WinstonError):
+                if attempt:
+                    raise
+
+    def get_waveforms(self, network, station, location, channel,
+                      starttime, endtime):
+        payload = self._get_raw(network, station, location, channel, starttime, endtime)
+        stream = parse_tracebufs(payload)
+        stream.trim(UTCDateTime(starttime), UTCDateTime(endtime))
+        return stream
+
+    def iter_waveforms_bulk(self, bulk):
+        # Spread the requests over the connection pool, handing back each
+        # stream as soon as it arrives
+        with ThreadPoolExecutor(max_workers = self.pool_size) as executor:
+            futures = {executor.submit(self._get_waveforms_or_empty, request): idx
+                       for idx, request in enumerate(bulk)}
+            for future in as_completed(futures):
+                yield (futures[future], future.result())
+
+    def get_coverage_bulk(self, bulk):
+        # Winston can't say what it has without sending it, but the tracebuf
+        # headers are enough; the samples are never decoded.
+        def covered(request):
+            try:
+                payload = self._get_raw(*request)
+            except Exception as e:
+                print("Unable to retrieve data for", request[1], e)
+                return 0.0
+            return span_coverage(tracebuf_spans(payload), request[4], request[5])
+
+        with ThreadPoolExecutor(max_workers = self.pool_size) as executor:
+            return list(executor.map(covered, bulk))
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def tracebuf_spans(payload):
+    # (start, end) timestamps of each packet in a GETSCNLRAW payload
+    spans = []
+    pos = 0
+    while pos + TRACEBUF_HEADER_SIZE <= len(payload):
+        head = payload[pos:pos + TRACEBUF_HEADER_SIZE]
+        endian = '>' if head[57:58] in (b's', b't') else '<'
+        _, nsamp, start, _, rate = struct.unpack_from(endian + '2i3d', head)
+        pos += TRACEBUF_HEADER_SIZE + nsamp * int(head[58:59])
+        spans.append((start, start + nsamp / rate))
+
+    return spans
+
+
+def parse_tracebufs(payload):
+    """
+    Turn a GETSCNLRAW payload into an ObsPy stream, joining contiguous
+    packets into a single trace.
+    """
+    traces = []
+    current = None
+    pos = 0
+    while pos + TRACEBUF_HEADER_SIZE <= len(payload):
+        head = payload[pos:pos + TRACEBUF_HEADER_SIZE]
+        pos += TRACEBUF_HEADER_SIZE
+
+        # datatype is e.g. s4, i4, t8, f8. s and t are big endian, i and f little.
+        dtype = head[57:59].decode()
+        endian = '>' if dtype[0] in 'st' else '<'
+        kind = 'i' if dtype[0] in 'si' else 'f'
+
+        (_, nsamp, start, _, rate, sta, net, chan, loc,
+         _, _, _, _) = struct.unpack(endian + TRACEBUF_HEADER, head)
+
+        nbytes = nsamp * int(dtype[1])
+        data = numpy.frombuffer(payload, dtype = f"{endian}{kind}{dtype[1]}",
+                                count = nsamp, offset = pos)
+        pos += nbytes
+
+        ids = tuple(x.split(b'\x00', 1)[0].decode() for x in (net, sta, loc, chan))
+
+        # Continuation of the previous packet (within half a sample)?
+        if (current is not None and current['ids'] == ids and current['rate'] == rate
+                and abs(current['next'] - start) < 0.5 / rate):
+            current['data'].append(data)
+            current['next'] = start + nsamp / rate
+            continue
+
+        current = {'ids': ids, 'rate': rate, 'start': start,
+                   'next': start + nsamp / rate, 'data': [data]}
+        traces.append(current)
+
+    stream = Stream()
+    for trace in traces:
+        net, sta, loc, chan = trace['ids']
+        header = {
+            'network': net,
+            'station': sta,
+            'location': '' if loc == '--' else loc,
+            'channel': chan,
+            'sampling_rate': trace['rate'],
+            'starttime': UTCDateTime(trace['start']),
+        }
+        data = numpy.concatenate(trace['data']).astype(trace['data'][0].dtype.newbyteorder('='))
+        stream.append(Trace(data = data, header = header))
+
+    return stream
@@ -0,0 +1,183 @@
+"""
+Storage for computed spectrograms.
+
+The generator saves the frequency/time/power arrays it computes next to the
+waveform data for each segment, so the web app can draw full size images
+without running the spectrogram again. Each file is tagged with the
+SPECTROGRAM parameters it was computed with; if those don't match the
+current configuration, load() returns None and the caller recomputes.
+"""
+import json
+import os
+
+from io import BytesIO
+
+import numpy
+
+from . import pack
+from .config import config
+
+# Bump if the stored layout changes
+FORMAT_VERSION = 1
+
+# Range of power (dB) that the colormap covers. Anything outside it is drawn
+# in the end colors.
+NORM_MIN = -360
+NORM_MAX = -180
+
+
+def spectrogram_params():
+    """
+    The configured parameters that affect the computed spectrogram.
+    """
+    params = {
+        'version': FORMAT_VERSION,
+        'window_type': config['SPECTROGRAM']['WindowType'],
+        'window_size': config['SPECTROGRAM'].getint('WindowSize'),
+        'overlap': config['SPECTROGRAM'].getint('Overlap'),
+        'nfft': config['SPECTROGRAM'].getint('NFFT'),
+        'min_freq': config['SPECTROGRAM'].getint('MinFreq', 0),
+        'max_freq': config['SPECTROGRAM'].getint('MaxFreq', 10),
+        'streaming': config.getboolean('SPECTROGRAM', 'streaming', fallback = False),
+        'band_limit': config.getboolean('SPECTROGRAM', 'bandlimit', fallback = False),
+    }
+
+    # Streamed spectrograms are computed from filtered data
+    if params['streaming'] and config.getboolean('FILTER', 'enabled', fallback = True):
+        params['filter'] = [config.getfloat('FILTER', 'lowcut', fallback = .5),
+                            config.getfloat('FILTER', 'highcut', fallback = 15),
+                            config.getint('FILTER', 'order', fallback = 2)]
+
+    return params
+
+
+def params_key():
+    return json.dumps(spectrogram_params(), sort_keys = True)
+
+
+def spectra_path(filename):
+    # Same name as the image/waveform, with an npz extension
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def crop(spec):
+    """
+    Drop the frequency bins outside the displayed range (keeping one bin
+    either side so the edge cells draw the same).
+    """
+    frequencies, times, power = spec
+    min_freq = config['SPECTROGRAM'].getint('MinFreq', 0)
+    max_freq = config['SPECTROGRAM'].getint('MaxFreq', 10)
+
+    first = max(numpy.searchsorted(frequencies, min_freq) - 1, 0)
+    last = numpy.searchsorted(frequencies, max_freq, side = 'right') + 1
+    return (frequencies[first:last], times, power[first:last])
+
+
+def quantize(power):
+    """
+    Quantize power (dB) to uint8 over the colormap range. Values outside the
+    range are clipped, which is how they are drawn anyway.
+    """
+    scaled = (numpy.asarray(power) - NORM_MIN) * (255 / (NORM_MAX - NORM_MIN))
+    scaled = numpy.nan_to_num(scaled, nan = 0, posinf = 255, neginf = 0)
+    return numpy.clip(numpy.rint(scaled), 0, 255).astype(numpy.uint8)
+
+
+def dequantize(quantized):
+    return quantized.astype(numpy.float32) * ((NORM_MAX - NORM_MIN) / 255) + NORM_MIN
+
+
+def _arrays(spec):
+    frequencies, times, power = crop(spec)
+    if config.get('STORAGE', 'spectra', fallback = 'float32') == 'uint8':
+        power = quantize(power)
+    else:
+        power = power.astype(numpy.float32)
+
+    return {'params': params_key(), 'frequencies': frequencies, 'times': times,
+            'power': power}
+
+
+def save(filename, spec):
+    numpy.savez_compressed(spectra_path(filename), **_arrays(spec))
+
+
+def encode(spec):
+    # The contents of the file save would write
+    buffer = BytesIO()
+    numpy.savez_compressed(buffer, **_arrays(spec))
+    return buffer.getvalue()
+
+
+def load(filename, quantized = False):
+    """
+    Load the stored spectrogram for a segment, or None if it doesn't exist
+    or was computed with different parameters.
+
+    Power stored as uint8 is converted back to dB, unless quantized is True,
+    in which case it is returned as is for drawing with colormap.color_index.
+    """
+    try:
+        with numpy.load(BytesIO(pack.read(spectra_path(filename)))) as stored:
+            if str(stored['params']) != params_key():
+                return None
+
+            power = stored['power']
+            if power.dtype == numpy.uint8 and not quantized:
+                power = dequantize(power)
+
+            return (stored['frequencies'], stored['times'], power)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def decimate(spec, factor):
+    # Average power (dB) over each run of factor time columns
+    frequencies, times, power = spec
+    if factor <= 1 or len(times) == 0:
+        return spec
+
+    starts = numpy.arange(0, len(times), factor)
+    counts = numpy.diff(numpy.append(starts, len(times)))
+    power = numpy.add.reduceat(numpy.asarray(power, dtype = numpy.float64), starts, axis = 1) / counts
+    times = times[starts] + (times[starts + counts - 1] - times[starts]) / 2
+    return (frequencies, times, power)
+
+
+def encode_reduced(spec, edges, env_min, env_max, factor):
+    """
+    The spectra file for a compacted window (see retention): the spectrogram
+    decimated in time by factor and quantized, plus a min/max waveform
+    envelope between the column edges (seconds), in place of the waveform.
+    """
+    frequencies, times, power = decimate(crop(spec), factor)
+    buffer = BytesIO()
+    numpy.savez_compressed(buffer, params = params_key(), frequencies = frequencies,
+                           times = times, power = quantize(power), env_edges = edges,
+                           env_min = env_min.astype(numpy.float32),
+                           env_max = env_max.astype(numpy.float32), decimation = factor)
+    return buffer.getvalue()
+
+
+def load_reduced(filename):
+    """
+    The stored data for a compacted window, as a dict of spec, edges,
+    env_min, env_max and decimation, or None if the window isn't compacted.
+    Unlike load, this doesn't check the spectrogram parameters, as there is
+    nothing left to recompute it from.
+    """
+    try:
+        with numpy.load(BytesIO(pack.read(spectra_path(filename)))) as stored:
+            if 'env_edges' not in stored.files:
+                return None
+
+            return {
+                'spec': (stored['frequencies'], stored['times'], dequantize(stored['power'])),
+                'edges': stored['env_edges'],
+                'env_min': stored['env_min'],
+                'env_max': stored['env_max'],
+                'decimation': int(stored['decimation']),
+            }
+    except (OSError, KeyError, ValueError):
+        return None
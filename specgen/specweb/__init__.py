@@ -2,4 +2,4 @@ import flask
 
 app = flask.Flask(__name__)
 
-from . import main
+from . import data, main, mosaic, packed
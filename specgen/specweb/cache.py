@@ -0,0 +1,156 @@
+"""
+Cache for rendered images.
+
+Rendered images are kept in a small in-memory LRU per process, backed by a
+size-bounded directory on disk that is shared between all the web server
+processes. Keys are hashes of everything that goes into an image (request
+parameters, spectrogram settings and source file modification times), so a
+regenerated segment naturally gets a new key, and the key doubles as a
+strong ETag.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+
+from specgen import pack
+from specgen.config import config
+
+
+def cache_key(*parts, files = ()):
+    """
+    Hash the given parts, plus the version of each file (or the fact that it
+    doesn't exist). Files may be loose or packed.
+    """
+    file_info = [(path, pack.version(path)) for path in files]
+
+    key_data = json.dumps([parts, file_info], sort_keys = True, default = str)
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, cache_dir, memory_items = 64, disk_bytes = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._written = 0  # Bytes written since the disk usage was last checked
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last = False)
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)  # Mark as recently used for disk eviction
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+
+        # Only look at the whole directory once in a while
+        self._written += len(data)
+        if self._written > self.disk_bytes // 10:
+            self._written = 0
+            self.trim()
+
+    def trim(self):
+        # Drop the least recently used files until under the size limit
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def image_cache():
+    cache_dir = config.get('WEB', 'cachedir', fallback = 'cache/images')
+    if not cache_dir.startswith('/'):
+        cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), cache_dir)
+
+    return RenderCache(cache_dir,
+                       config.getint('WEB', 'memorycacheitems', fallback = 64),
+                       config.getint('WEB', 'diskcachemb', fallback = 512) * 1024 * 1024)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Merge concurrent calls for the same key, so that the function only runs
+    once and every caller gets its result.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,112 @@
+"""
+Spectral data for client side rendering.
+
+/spectra returns the stored spectra and waveform envelope for one station
+over an arbitrary time range, stitched from the stored segments (or the
+overview tiles, for long ranges) and reduced to the requested number of
+columns. The response is binary, laid out like the segment files:
+
+    8 bytes   magic, b'SPECDAT1'
+    4 bytes   header length, little endian uint32
+    header    JSON, padded with spaces so the data starts 8 byte aligned
+    data      the arrays listed in the header, each at its byte offset from
+              the start of the data, so they can be used as typed arrays
+              directly
+
+The arrays are power (uint8, rows x columns, lowest frequency first, dB
+quantized linearly between db_min and db_max, with 255 for no data), and
+env_min/env_max (little endian float32 per column, NaN for no data).
+"""
+import json
+import struct
+
+from datetime import datetime, timedelta
+
+import flask
+import numpy
+
+from obspy import UTCDateTime
+
+from . import app
+from .main import plots_dir, set_cache_control
+from specgen import overview
+from specgen.config import config, stations
+from specgen.spectra import NORM_MAX, NORM_MIN
+
+MAGIC = b'SPECDAT1'
+NO_DATA = 255
+
+MAX_WIDTH = 4096
+MAX_ROWS = 512
+
+
+def quantize(power, db_min, db_max):
+    scaled = (power - db_min) * ((NO_DATA - 1) / (db_max - db_min))
+    quantized = numpy.clip(numpy.rint(numpy.nan_to_num(scaled, nan = 0)), 0, NO_DATA - 1)
+    quantized = quantized.astype(numpy.uint8)
+    quantized[numpy.isnan(power)] = NO_DATA
+    return quantized
+
+
+def encode(header, arrays):
+    data = []
+    offset = 0
+    header['arrays'] = []
+    for name, array in arrays:
+        array = numpy.ascontiguousarray(array)
+        header['arrays'].append({'name': name, 'dtype': array.dtype.str,
+                                 'shape': array.shape, 'offset': offset})
+        data.append(array.tobytes())
+        offset += array.nbytes
+        padding = -offset % 8
+        data.append(b'\0' * padding)
+        offset += padding
+
+    header = json.dumps(header).encode()
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + data)
+
+
+@app.route('/spectra')
+def get_spectra():
+    args = flask.request.args
+    station = args['station']
+    if station not in stations:
+        flask.abort(404)
+
+    start = datetime.strptime(args['start'], '%Y-%m-%dT%H:%M:%S')
+    end = datetime.strptime(args['end'], '%Y-%m-%dT%H:%M:%S')
+    width = min(int(args.get('width', 1000)), MAX_WIDTH)
+    rows = min(int(args.get('rows', overview.FREQ_ROWS)), MAX_ROWS)
+    db_min = float(args.get('dbmin', NORM_MIN))
+    db_max = float(args.get('dbmax', NORM_MAX))
+
+    max_hours = config.getint('WEB', 'maximagehours', fallback = 7 * 24)
+    if (end <= start or end - start > timedelta(hours = max_hours) or width < 1
+            or rows < 1 or db_max <= db_min):
+        flask.abort(400)
+
+    tile = overview.assemble(plots_dir(), station, UTCDateTime(start), UTCDateTime(end),
+                             width, rows)
+
+    header = {
+        'station': station,
+        'start': start.strftime('%Y-%m-%dT%H:%M:%S'),
+        'end': end.strftime('%Y-%m-%dT%H:%M:%S'),
+        'columns': width,
+        'rows': rows,
+        'frequencies': tile.frequencies.tolist(),
+        'db_min': db_min,
+        'db_max': db_max,
+        'no_data': NO_DATA,
+    }
+    body = encode(header, [
+        ('power', quantize(tile.mean_power(), db_min, db_max)),
+        ('env_min', tile.env_min.astype('<f4')),
+        ('env_max', tile.env_max.astype('<f4')),
+    ])
+
+    response = flask.Response(body, mimetype = 'application/octet-stream')
+    response.add_etag()
+    set_cache_control(response, end)
+    return response.make_conditional(flask.request)
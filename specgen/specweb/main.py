@@ -1,20 +1,46 @@
-import bz2
 import json
 import os
-import pickle
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import flask
+import numpy
 
-from matplotlib import pyplot as plt
-from matplotlib import dates as mdates
-from matplotlib.colors import Normalize
+from obspy import UTCDateTime
 
 from . import app
-from specgen import graphing
-from specgen.config import locations, stations
+from .cache import SingleFlight, cache_key, image_cache
+from specgen import availability, graphing, overview, segment, spectra
+from specgen.config import config, locations, stations
+from specgen.generate import cache_db_path
+
+render_cache = image_cache()
+renders = SingleFlight()
+
+# Station files are decompressed in parallel (zlib and bz2 release the GIL).
+load_pool = ThreadPoolExecutor(max_workers = config.getint('WEB', 'loadthreads', fallback = 8))
+
+# Limit how many images are drawn at once, so a burst of requests can't tie
+# up every web server worker.
+render_slots = threading.BoundedSemaphore(config.getint('WEB', 'renderslots', fallback = 2))
+
+
+def request_stations():
+    # The stations argument: a JSON list of configured station names
+    try:
+        target_stations = json.loads(flask.request.args['stations'])
+    except ValueError:
+        flask.abort(400)
+
+    max_stations = config.getint('WEB', 'maxstations', fallback = 10)
+    if (not isinstance(target_stations, list) or not 0 < len(target_stations) <= max_stations
+            or not all(isinstance(sta, str) and sta in stations for sta in target_stations)):
+        flask.abort(400)
+
+    return target_stations
 
 
 @app.route("/")
@@ -35,63 +61,239 @@ def get_locations():
     return flask.jsonify(ret_obj)
 
 
+@app.route('/availability')
+def get_availability():
+    """
+    The status (ok, partial, missing, or null if never processed) and data
+    coverage of every window for the given stations between start and end.
+    """
+    target_stations = request_stations()
+    try:
+        start = datetime.strptime(flask.request.args['start'], '%Y-%m-%dT%H:%M:%S')
+        end = datetime.strptime(flask.request.args['end'], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        flask.abort(400)
+
+    # Same limit as for images, so a request can't pull a station's whole history
+    max_hours = config.getint('WEB', 'maximagehours', fallback = 7 * 24)
+    if end <= start or end - start > timedelta(hours = max_hours):
+        flask.abort(400)
+
+    interval = timedelta(minutes = config['GLOBAL'].getint('minutesperimage', 10))
+    window_ends = []
+    window_end = start + interval
+    while window_end <= end:
+        window_ends.append(window_end.strftime('%Y-%m-%dT%H:%M:%S'))
+        window_end += interval
+
+    recorded = availability.query(cache_db_path(), target_stations, start, end)
+    grid = {}
+    for sta in target_stations:
+        windows = [recorded[sta].get(window_end, (None, None)) for window_end in window_ends]
+        grid[sta] = {'status': [window[0] for window in windows],
+                     'coverage': [window[1] for window in windows]}
+
+    return flask.jsonify({'interval': int(interval.total_seconds()),
+                          'times': window_ends,
+                          'stations': grid})
+
+
+def plots_dir():
+    static_folder = app.config.get('static_folder', 'static')
+    return os.path.join(os.path.dirname(__file__), static_folder, 'plots')
+
+
 @app.route('/fullImage')
 def get_full_image():
-    target_stations = json.loads(flask.request.args['stations'])
+    if 'start' in flask.request.args:
+        return get_range_image()
+
+    target_stations = request_stations()
     volcano = flask.request.args['volcano']
 
-    plot_path = os.path.dirname(__file__)
-    static_folder = app.config.get('static_folder', 'static')
-    target_date = datetime.strptime(flask.request.args['time'], '%Y-%m-%dT%H:%M:%S')
+    try:
+        target_date = datetime.strptime(flask.request.args['time'], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        flask.abort(400)
     year = str(target_date.year)
     month = str(target_date.month)
     day = str(target_date.day)
-    target_filename = f"{target_date.strftime('%Y%m%dT%H%M%S')}.pbz2"
+    target_filename = f"{target_date.strftime('%Y%m%dT%H%M%S')}.seg"
+
+    plot_data_paths = [os.path.join(plots_dir(), sta, year, month, day, target_filename)
+                       for sta in target_stations]
 
-    plot_height = 1.52 * len(target_stations) + 1
-    plot_width = 5.76
-    num_plots = 2 * len(target_stations)
-    ratios = [3, 10] * len(target_stations)
-    dpi = 100
+    # Past segments don't change unless they are regenerated, which changes
+    # the source file times and so the key.
+    source_files = [path for plot_data_path in plot_data_paths
+                    for path in (segment.segment_path(plot_data_path),
+                                 spectra.spectra_path(plot_data_path))]
+    etag = cache_key('fullImage', target_stations, target_date.isoformat(),
+                     volcano, spectra.params_key(), files = source_files)
 
-    plt.rcParams.update({'font.size': 7})
-    fig = plt.figure(dpi = dpi, figsize = (plot_width, plot_height))
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status = 304)
+    else:
+        # Identical requests that arrive while this image is being drawn wait
+        # for it rather than drawing it again.
+        img = renders.do(etag, cached_render, etag, render_full_image, volcano,
+                         target_date, target_stations, plot_data_paths)
+        response = flask.Response(img, mimetype = 'image/png')
+
+    response.set_etag(etag)
+    set_cache_control(response, target_date)
+    return response
+
+
+def set_cache_control(response, window_end):
+    # Once a window is old enough that no more data is expected for it, let
+    # clients hold on to it. Until then, they must check back each time.
+    closed_after = config.getint('WEB', 'closedafterminutes', fallback = 120)
+    if datetime.utcnow() - window_end > timedelta(minutes = closed_after):
+        response.cache_control.public = True
+        response.cache_control.max_age = config.getint('WEB', 'closedmaxage', fallback = 86400)
+    else:
+        response.cache_control.no_cache = True
+
+
+def get_range_image():
+    """
+    A full image for any start/end range, stitched from the stored segments
+    (or overview tiles, for long ranges) and reduced to the image width, so
+    memory use and render time stay about the same however long the range.
+    """
+    target_stations = request_stations()
+    volcano = flask.request.args['volcano']
+    try:
+        start = datetime.strptime(flask.request.args['start'], '%Y-%m-%dT%H:%M:%S')
+        end = datetime.strptime(flask.request.args['end'], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        flask.abort(400)
 
-    gs = fig.add_gridspec(num_plots, hspace = 0, height_ratios = ratios)
-    axes = gs.subplots(sharex = True)
+    max_hours = config.getint('WEB', 'maximagehours', fallback = 7 * 24)
+    if end <= start or end - start > timedelta(hours = max_hours):
+        flask.abort(400)
+
+    # Any window in the range being regenerated changes the key
+    updated = availability.last_updated(cache_db_path(), target_stations, start, end)
+    key = cache_key('rangeImage', target_stations, start.isoformat(), end.isoformat(),
+                    volcano, spectra.params_key(), updated)
+
+    if flask.request.if_none_match.contains(key):
+        response = flask.Response(status = 304)
+    else:
+        img = renders.do(key, cached_render, key, render_range_image, volcano, start,
+                         end, target_stations)
+        response = flask.Response(img, mimetype = 'image/png')
+
+    response.set_etag(key)
+    set_cache_control(response, end)
+    return response
+
+
+def cached_render(key, render, *args):
+    img = render_cache.get(key)
+    if img is not None:
+        return img
+
+    wait = config.getfloat('WEB', 'renderwait', fallback = 30)
+    if not render_slots.acquire(timeout = wait):
+        response = flask.Response("Too many images being drawn, try again shortly",
+                                  status = 503)
+        response.headers['Retry-After'] = '5'
+        flask.abort(response)
+
+    try:
+        img = render(*args)
+    finally:
+        render_slots.release()
+
+    render_cache.put(key, img)
+    return img
+
+
+def load_station(plot_data_path):
+    # Returns (times, data, spectrogram), the reduced data of a compacted
+    # window (a dict, see spectra.load_reduced), or None if there is neither
+    try:
+        waveform_times, z_data = segment.load(plot_data_path)
+    except FileNotFoundError:
+        return spectra.load_reduced(plot_data_path)
+
+    # Use the spectrogram stored by the generator, if it is still valid.
+    # Otherwise set_station will compute it.
+    return (waveform_times, z_data, spectra.load(plot_data_path, quantized = True))
+
+
+def render_full_image(volcano, target_date, target_stations, plot_data_paths):
     title = f"{volcano} {target_date.strftime('%Y-%m-%d')}"
-    axes[0].set_title(title, fontsize=12, fontweight = 'bold')
 
-    for idx, sta in enumerate(target_stations):
-        plot_data_path = os.path.join(plot_path, static_folder, 'plots',
-                                      sta, year, month, day, target_filename)
+    # Load everything before taking the figure, so that the load time is
+    # that of the slowest station, not the sum of all of them.
+    station_data = list(load_pool.map(load_station, plot_data_paths))
+
+    # The figure layout only depends on the number of stations, so is built
+    # once and reused.
+    figure = graphing.spectrograph_figure(len(target_stations), title = True)
+    with figure.lock:
+        figure.set_title(title)
+
+        for idx, (sta, loaded) in enumerate(zip(target_stations, station_data)):
+            station_label = f"{sta}.{stations[sta]['CHAN']}"
+            if loaded is None:
+                figure.clear_station(idx, station_label)
+            elif isinstance(loaded, dict):
+                edges = (loaded['edges'] * 1000).astype('datetime64[ms]')
+                figure.set_station_reduced(idx, edges, loaded['env_min'], loaded['env_max'],
+                                           loaded['spec'], station_label)
+            else:
+                figure.set_station(idx, *loaded)
+
+        if all(loaded is None for loaded in station_data):
+            # Nothing set the range, so it would be left at the last image's
+            interval = timedelta(minutes = config['GLOBAL'].getint('minutesperimage', 10))
+            figure.set_time_range(numpy.datetime64(target_date - interval, 'ms'),
+                                  numpy.datetime64(target_date, 'ms'))
+
+        img = BytesIO()
+        figure.save(img, format = "png")
+
+    return img.getvalue()
+
+
+def render_range_image(volcano, start, end, target_stations):
+    title = f"{volcano} {start.strftime('%Y-%m-%d %H:%M')} - {end.strftime('%Y-%m-%d %H:%M')}"
+
+    figure = graphing.spectrograph_figure(len(target_stations), title = True)
+
+    # About one column per pixel of the spectrogram axes
+    width = int(figure.fig.get_figwidth() * figure.fig.dpi)
+    rows = max(int(figure.fig.get_figheight() * figure.fig.dpi / len(target_stations)), 1)
+
+    def assemble(sta):
+        return overview.assemble(plots_dir(), sta, UTCDateTime(start), UTCDateTime(end),
+                                 width, rows)
 
-        ax_idx = 2 * idx
-        ax1 = axes[ax_idx]
-        ax2 = axes[ax_idx + 1]
+    tiles = list(load_pool.map(assemble, target_stations))
 
-        try:
-            with bz2.BZ2File(plot_data_path, 'r') as figure_file:
-                waveform_times = pickle.load(figure_file)
-                z_data = pickle.load(figure_file)
+    with figure.lock:
+        figure.set_title(title)
 
-                graphing.gen_station_subplots(waveform_times, z_data, ax1, ax2)
-        except FileNotFoundError:
+        for idx, (sta, tile) in enumerate(zip(target_stations, tiles)):
             station_label = f"{sta}.{stations[sta]['CHAN']}"
-            graphing.configure_spectrograph_y(station_label, ax1, ax2)
+            if tile.empty():
+                figure.clear_station(idx, station_label)
+                continue
 
-    axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-    side_padding = 25 / (plot_width * dpi)
-    bottom_padding = 25 / (plot_height * dpi)
-    fig.tight_layout(pad = 0, rect = (side_padding, bottom_padding,
-                                      1 - side_padding, 1))
+            edges = (tile.edges * 1000).astype('datetime64[ms]')
+            spec = (tile.frequencies, None, tile.mean_power())
+            figure.set_station_reduced(idx, edges, tile.env_min, tile.env_max, spec,
+                                       station_label)
 
-    print(waveform_times)
-    print(z_data)
+        # Stations without data don't set the range themselves
+        figure.set_time_range(numpy.datetime64(start, 'ms'), numpy.datetime64(end, 'ms'))
 
-    img = BytesIO()
-    fig.savefig(img, format = "png")
-    img.seek(0)
+        img = BytesIO()
+        figure.save(img, format = "png")
 
-    plt.close(fig)
-    return flask.send_file(img, mimetype = 'image/png')
+    return img.getvalue()
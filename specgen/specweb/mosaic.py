@@ -0,0 +1,206 @@
+"""
+Whole mosaic grids in one request.
+
+/mosaic/layout describes the grid for a time range (which tiles exist, and
+where each one is in the sprite sheet), and /mosaic returns the sprite sheet
+itself: every tile of the grid composed into a single PNG. A page view is
+then two requests, instead of one per station per cell.
+"""
+import json
+import os
+
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import flask
+import numpy
+
+from PIL import Image
+
+from . import app
+from .main import plots_dir, render_cache, renders, request_stations, set_cache_control
+from .cache import cache_key
+from specgen import pack
+from specgen.config import config
+from specgen.graphing import image_extension
+from specgen.png import encode_png
+from specgen.raster import THUMB_HEIGHT, THUMB_WIDTH
+
+# Length of the individual images, which make the finest level
+WINDOW_SECONDS = config['GLOBAL'].getint('minutesperimage', 10) * 60
+
+MAX_COLUMNS = 48
+
+# Image levels, finest first: (file prefix, seconds per cell, longest span in
+# hours to use it for, label format for the page). The coarsest level whose
+# span covers the request is used.
+LEVELS = (
+    ('small_', WINDOW_SECONDS, 6, 'HH:mm'),
+    ('1h_', 60 * 60, 72, 'MM-DD HH:mm'),
+    ('1d_', 24 * 60 * 60, None, 'YYYY-MM-DD'),
+)
+
+
+def mosaic_level(hours):
+    for level in LEVELS:
+        if level[2] is None or hours <= level[2]:
+            return level
+
+
+def tile_file(station, prefix, start, end):
+    # The individual images are named by their end time, overview tiles by
+    # their start time
+    when = end if prefix == 'small_' else start
+    base = os.path.join(plots_dir(), station, str(when.year), str(when.month),
+                        str(when.day), f"{prefix}{when.strftime('%Y%m%dT%H%M%S')}")
+
+    # Images made before RENDER/ThumbnailFormat was changed keep their old
+    # extension until they are regenerated
+    path = base + image_extension()
+    other = base + ('.png' if image_extension() == '.webp' else '.webp')
+    if not pack.exists(path) and pack.exists(other):
+        return other
+    return path
+
+
+def mosaic_args():
+    args = flask.request.args
+    stations = request_stations()
+    try:
+        start = datetime.strptime(args['start'], '%Y-%m-%dT%H:%M:%S')
+        hours = int(args.get('hours', 2))
+        columns = int(args.get('columns', 6))
+    except ValueError:
+        flask.abort(400)
+
+    max_hours = config.getint('WEB', 'maximagehours', fallback = 7 * 24)
+    if not 0 < hours <= max_hours or columns < 1:
+        flask.abort(400)
+
+    return (stations, start, hours, min(columns, MAX_COLUMNS))
+
+
+def mosaic_cells(stations, start, hours, columns):
+    """
+    The level used, and a list of (row, column, start, end, tile files) for
+    each cell in the grid.
+    """
+    level = mosaic_level(hours)
+    prefix, seconds = level[:2]
+
+    # Align the start to a cell boundary
+    start = start.replace(second = 0, microsecond = 0)
+    if seconds >= 24 * 60 * 60:
+        start = start.replace(hour = 0, minute = 0)
+    elif seconds >= 60 * 60:
+        start = start.replace(minute = 0)
+    else:
+        midnight = start.replace(hour = 0, minute = 0)
+        offset = (start - midnight).total_seconds()
+        start = midnight + timedelta(seconds = offset - offset % seconds)
+
+    end = start + timedelta(hours = hours)
+    step = timedelta(seconds = seconds)
+
+    cells = []
+    cell_start = start
+    while cell_start < end:
+        cell_end = cell_start + step
+        idx = len(cells)
+        files = [tile_file(sta, prefix, cell_start, cell_end) for sta in stations]
+        cells.append((idx // columns, idx % columns, cell_start, cell_end, files))
+        cell_start = cell_end
+
+    return (level, cells)
+
+
+def mosaic_key(kind, stations, hours, columns, cells):
+    files = [path for cell in cells for path in cell[4]]
+    return cache_key(kind, stations, hours, columns, files = files)
+
+
+def cached_response(etag, range_end, mimetype, make_body):
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status = 304)
+    else:
+        response = flask.Response(make_body(), mimetype = mimetype)
+
+    response.set_etag(etag)
+    set_cache_control(response, range_end)
+    return response
+
+
+@app.route('/mosaic/layout')
+def get_mosaic_layout():
+    stations, start, hours, columns = mosaic_args()
+    level, cells = mosaic_cells(stations, start, hours, columns)
+
+    def make_layout():
+        layout = {
+            'level': {'prefix': level[0], 'seconds': level[1], 'label': level[3]},
+            'stations': stations,
+            'columns': columns,
+            'cell_width': THUMB_WIDTH,
+            'cell_height': THUMB_HEIGHT,
+            'sprite': flask.url_for('get_mosaic', **flask.request.args),
+            'cells': [{
+                'row': row,
+                'column': column,
+                'start': cell_start.strftime('%Y-%m-%dT%H:%M:%S'),
+                'end': cell_end.strftime('%Y-%m-%dT%H:%M:%S'),
+                'available': [pack.exists(path) for path in files],
+            } for row, column, cell_start, cell_end, files in cells],
+        }
+        return json.dumps(layout)
+
+    etag = mosaic_key('mosaic/layout', stations, hours, columns, cells)
+    return cached_response(etag, cells[-1][3] if cells else start,
+                           'application/json', make_layout)
+
+
+@app.route('/mosaic')
+def get_mosaic():
+    """
+    The sprite sheet for a mosaic. Each cell is a column of station tiles,
+    one above the other, so the tile for station i of the cell at (row, col)
+    is at x = col * width, y = (row * len(stations) + i) * height. Missing
+    tiles are left white.
+    """
+    stations, start, hours, columns = mosaic_args()
+    level, cells = mosaic_cells(stations, start, hours, columns)
+
+    etag = mosaic_key('mosaic', stations, hours, columns, cells)
+
+    def make_sprite():
+        img = render_cache.get(etag)
+        if img is None:
+            img = compose(stations, columns, cells)
+            render_cache.put(etag, img)
+        return img
+
+    return cached_response(etag, cells[-1][3] if cells else start, 'image/png',
+                           lambda: renders.do(etag, make_sprite))
+
+
+def compose(stations, columns, cells):
+    rows = cells[-1][0] + 1 if cells else 0
+    sheet = numpy.full((max(rows * len(stations), 1) * THUMB_HEIGHT,
+                        max(min(columns, len(cells)), 1) * THUMB_WIDTH, 3),
+                       255, dtype = numpy.uint8)
+
+    for row, column, _, _, files in cells:
+        for idx, path in enumerate(files):
+            try:
+                data = pack.read(path)
+            except FileNotFoundError:
+                continue
+
+            # PNG or WebP, whichever the file is
+            tile = numpy.asarray(Image.open(BytesIO(data)).convert('RGB'))
+            tile = tile[:THUMB_HEIGHT, :THUMB_WIDTH]
+
+            y = (row * len(stations) + idx) * THUMB_HEIGHT
+            x = column * THUMB_WIDTH
+            sheet[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+
+    return encode_png(sheet)
@@ -0,0 +1,71 @@
+"""
+Window files kept in the station-day containers (see specgen.pack).
+
+The /static/plots/... URLs keep working for packed files: anything that
+isn't there as a loose file is looked up in the container for its directory.
+/pack/<station>/<date> serves a whole container (with byte range support),
+and /pack/<station>/<date>/index says where each file is in it, so clients
+can fetch individual thumbnails with range requests.
+"""
+import mimetypes
+import os
+
+from datetime import datetime
+
+import flask
+
+from werkzeug.security import safe_join
+
+from . import app
+from .main import plots_dir
+from specgen import pack
+
+
+@app.route('/static/plots/<path:filename>')
+def get_plot_file(filename):
+    path = safe_join(plots_dir(), filename)
+    if path is None:
+        flask.abort(404)
+
+    if os.path.isfile(path):
+        return flask.send_file(path, conditional = True)
+
+    found = pack.find(path)
+    if found is None:
+        flask.abort(404)
+
+    container, offset, length = found
+    with open(container, 'rb') as pack_file:
+        stat = os.fstat(pack_file.fileno())
+        pack_file.seek(offset)
+        body = pack_file.read(length)
+
+    response = flask.Response(body, mimetype = mimetypes.guess_type(path)[0]
+                              or 'application/octet-stream')
+    # Packed files are never changed in place, so where one is identifies it,
+    # as long as the container itself wasn't replaced (e.g. by compaction)
+    response.set_etag(f"{stat.st_ino}-{stat.st_mtime_ns}-{offset}-{length}")
+    return response.make_conditional(flask.request, accept_ranges = True,
+                                     complete_length = length)
+
+
+def day_pack(station, date):
+    day = datetime.strptime(date, '%Y-%m-%d')
+    path = safe_join(plots_dir(), station, str(day.year), str(day.month),
+                     str(day.day), pack.PACK_NAME)
+    if path is None or not os.path.isfile(path):
+        flask.abort(404)
+    return path
+
+
+@app.route('/pack/<station>/<date>')
+def get_pack(station, date):
+    return flask.send_file(day_pack(station, date), conditional = True,
+                           mimetype = 'application/octet-stream')
+
+
+@app.route('/pack/<station>/<date>/index')
+def get_pack_index(station, date):
+    members = pack.index(day_pack(station, date))
+    return flask.jsonify({name: {'offset': offset, 'length': length}
+                          for name, (offset, length) in members.items()})
@@ -5,6 +5,7 @@ var sitesByVolcano = null;
 
 $(document).ready(function() {
     $(document).on('click', '.mosaicSegment', getFullImage);
+    $(document).on('click', '.rowStart', getRowImage);
     $(document).on('change', 'input.stationOption', showMosaic);
     $('#settingsToggle').click(toggleSettings);
     $('#volcano').change(changeVolcano);
@@ -168,17 +169,8 @@ function changeVolcano() {
 
 function showMosaic() {
     var startTime = dayjs($('#startTime').val());
-    //make sure that minutes are on a 10-minute mark
-    var start_minute = startTime.minute() - startTime.minute() % 10;
-    startTime = startTime.minute(start_minute);
+    var hours = Number($('#numHours').val());
 
-    var period = $('#numHours').val() * 60 * 60 * 1000 //miliseconds
-    var endTime = startTime.add(period);
-
-    var curTime = startTime.format("HH:mm");
-    var timeDiv = `<div class="dateBoundry"><span class="dateLabel">${curTime}</span></div>`;
-    $('#mosaic').empty();
-    var count = 0;
     stations = [];
     $('input.stationOption:checked').each(function(idx, element) {
         stations.push($(element).data('station'))
@@ -193,9 +185,44 @@ function showMosaic() {
         console.error('No local storage. Unable to save station selections.');
     }
 
-    while (startTime < endTime) {
+    //The server works out the grid (and which images exist), and sends all
+    //the images as one sprite sheet
+    var args = {
+        start: startTime.format('YYYY-MM-DDTHH:mm:ss'),
+        hours: hours,
+        columns: columns,
+        stations: JSON.stringify(stations)
+    }
+
+    var volcano = $('#volcano').val();
+    $.getJSON('mosaic/layout', args)
+        .done(function(layout) {
+            drawMosaic(layout, volcano);
+        });
+}
+
+function drawMosaic(layout, volcano) {
+    var level = layout.level;
+    var cells = layout.cells;
+    var stations = layout.stations;
+
+    $('#mosaic').empty();
+    if (cells.length === 0)
+        return;
+
+    var curTime = dayjs(cells[0].start).format(level.label);
+    var timeDiv = `<div class="dateBoundry"><span class="dateLabel">${curTime}</span></div>`;
+
+    for (var count = 0; count < cells.length; count++) {
+        var cell = cells[count];
         if (count % columns === 0) {
             var startDiv = $('<div class=rowStart>');
+            var rowEnd = cells[Math.min(count + columns, cells.length) - 1].end;
+            startDiv.data('start', cell.start);
+            startDiv.data('end', rowEnd);
+            startDiv.data('stations', stations);
+            startDiv.data('volcano', volcano);
+
             var siteDiv = $('<div class=siteDiv>');
             for (var i = 0; i < stations.length; i++) {
                 var site = stations[i];
@@ -205,66 +232,75 @@ function showMosaic() {
             startDiv.append(siteDiv);
             $('#mosaic').append(startDiv);
         }
-        startTime = startTime.add(10 * 60 * 1000); //add 10 minutes
+
+        var endTime = dayjs(cell.end);
         var imgDiv = $('<div class=mosaicSegment>');
-        imgDiv.data('time', startTime);
+        imgDiv.data('time', endTime);
+        imgDiv.data('start', dayjs(cell.start));
+        imgDiv.data('level', level);
         imgDiv.data('stations', stations);
-        imgDiv.data('volcano', $('#volcano').val());
+        imgDiv.data('volcano', volcano);
 
         $('#mosaic').append(imgDiv);
         for (var i = 0; i < stations.length; i++) {
-            var sta = stations[i];
-            var url = genImageUrl(startTime, sta);
-            var img = `<img src="${url}"  class="mosaicImg" onerror="mosaicImgErr(this)">`;
-            imgDiv.append(img);
+            if (!cell.available[i]) {
+                imgDiv.append('<div class=mosaicImg>No Data</div>');
+                continue;
+            }
+
+            var x = cell.column * layout.cell_width;
+            var y = (cell.row * stations.length + i) * layout.cell_height;
+            var style = `background: url('${layout.sprite}') -${x}px -${y}px`;
+            imgDiv.append(`<div class="mosaicImg" style="${style}"></div>`);
         }
 
-        count += 1;
-        if (count % columns === 0) {
-            curTime = startTime.format("HH:mm");
+        if ((count + 1) % columns === 0) {
+            curTime = endTime.format(level.label);
             timeDiv = `<div class="dateBoundry"><span class="dateLabel">${curTime}</span></div>`;
             $('#mosaic').append(timeDiv);
         }
     }
 }
 
-function mosaicImgErr(img) {
-    $(img).replaceWith('<div class=mosaicImg>No Data</div>');
+function openFullImage(args) {
+    var str = [];
+    for (var p in args)
+        if (args.hasOwnProperty(p)) {
+            str.push(encodeURIComponent(p) + "=" + encodeURIComponent(args[p]));
+        }
+    var query = str.join("&");
+    var url = `fullImage?${query}`;
+    window.open(url);
 }
 
-function genImageUrl(time, station) {
-    //time should be a dayjs object
-    var year = time.year();
-    var month = time.month() + 1; //actual month, not zero based
-    var day = time.date()
-
-    var url = `static/plots/${station}/${year}/${month}/${day}/`;
-
-    url += 'small_';
-
-    url += time.format("YYYYMMDDTHHmm00.png")
-
-    return url;
+function getRowImage() {
+    //One image covering the whole row
+    openFullImage({
+        start: $(this).data('start'),
+        end: $(this).data('end'),
+        stations: JSON.stringify($(this).data('stations')),
+        volcano: $(this).data('volcano')
+    });
 }
 
 function getFullImage() {
+    var level = $(this).data('level');
+    if (level.prefix !== 'small_') {
+        //Overview tile, zoom in to the period it covers
+        $('#startTime').val($(this).data('start').format('YYYY-MM-DD HH:mm'));
+        $('#numHours').val(level.seconds / (60 * 60));
+        startChanged();
+        return;
+    }
+
     var time = $(this).data('time').format('YYYY-MM-DDTHH:mm:ss');
     var req_stations = $(this).data('stations');
     var req_stations = JSON.stringify(req_stations);
     var volcano = $(this).data('volcano');
 
-    args = {
+    openFullImage({
         time: time,
         stations: req_stations,
         volcano: volcano
-    }
-
-    var str = [];
-    for (var p in args)
-        if (args.hasOwnProperty(p)) {
-            str.push(encodeURIComponent(p) + "=" + encodeURIComponent(args[p]));
-        }
-    var query = str.join("&");
-    var url = `fullImage?${query}`;
-    window.open(url);
+    });
 }
\ No newline at end of file
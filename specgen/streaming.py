@@ -0,0 +1,168 @@
+"""
+Incremental spectrogram computation across consecutive windows.
+
+Normally each window is processed on its own, so the spectrogram segments
+that would straddle a window boundary are simply lost. A StreamingSpectrogram
+instead keeps the unprocessed tail of the data it has seen (and the state of
+its band pass filter), so each new chunk of samples only produces the new
+spectral columns, and they line up seamlessly with the previous ones. Chunks
+can be any length, not just a full window.
+
+Between generator runs, the per-station state is pickled to the cache
+directory.
+"""
+import fcntl
+import os
+import pickle
+
+from contextlib import contextmanager
+
+import numpy
+
+from scipy.signal import butter, get_window, sosfilt, sosfilt_zi, spectrogram
+
+from .config import config
+from .spectra import crop, params_key, spectrogram_params
+
+
+def bandpass(sampling_rate):
+    # Filter from the FILTER config section, as second order sections
+    if not config.getboolean('FILTER', 'enabled', fallback = True):
+        return None
+
+    low = config.getfloat('FILTER', 'lowcut', fallback = .5)
+    high = config.getfloat('FILTER', 'highcut', fallback = 15)
+    order = config.getint('FILTER', 'order', fallback = 2)
+
+    if high >= sampling_rate / 2:
+        return butter(order, low, btype = 'highpass', fs = sampling_rate, output = 'sos')
+    return butter(order, [low, high], btype = 'bandpass', fs = sampling_rate, output = 'sos')
+
+
+class StreamingSpectrogram:
+    def __init__(self, sampling_rate):
+        params = spectrogram_params()
+        self.key = params_key()
+        self.sampling_rate = sampling_rate
+        self.nperseg = params['window_size']
+        self.noverlap = params['overlap']
+        self.nfft = params['nfft']
+        self.hop = self.nperseg - self.noverlap
+        self.window = get_window(params['window_type'], self.nperseg)
+        self.sos = bandpass(sampling_rate)
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+        self.buffer = numpy.empty(0)
+        self.buffer_start = None  # Timestamp of the first sample in the buffer
+        self.next_time = None  # Timestamp of the next sample we expect
+
+    def is_compatible(self, sampling_rate):
+        return self.key == params_key() and self.sampling_rate == sampling_rate
+
+    def push(self, trace):
+        """
+        Add the samples from an ObsPy trace. Returns the (frequencies, times,
+        power) for any new spectral columns, or None if the trace is entirely
+        older than data already seen.
+        """
+        rate = self.sampling_rate
+        start = trace.stats.starttime.timestamp
+        data = numpy.asarray(trace.data, dtype = numpy.float64)
+
+        if self.next_time is not None:
+            # Number of samples in this trace we have already seen
+            overlap = int(round((self.next_time - start) * rate))
+            if overlap >= len(data):
+                return None
+            if overlap < 0:
+                self.reset()  # Gap in the data, start over
+            elif overlap > 0:
+                data = data[overlap:]
+                start = self.next_time
+
+        if self.sos is not None and len(data):
+            if self.zi is None:
+                self.zi = sosfilt_zi(self.sos) * data[0]
+            data, self.zi = sosfilt(self.sos, data, zi = self.zi)
+
+        if self.buffer_start is None:
+            self.buffer_start = start
+        self.buffer = numpy.concatenate([self.buffer, data])
+        self.next_time = start + len(data) / rate
+
+        n_cols = 0
+        if len(self.buffer) >= self.nperseg:
+            n_cols = (len(self.buffer) - self.noverlap) // self.hop
+
+        if not n_cols:
+            frequencies = numpy.fft.rfftfreq(self.nfft, 1 / rate)
+            return self._output((frequencies, numpy.empty(0, dtype = 'datetime64[ms]'),
+                                 numpy.empty((len(frequencies), 0))))
+
+        used = self.buffer[:(n_cols - 1) * self.hop + self.nperseg]
+        frequencies, times, power = spectrogram(used, rate, self.window,
+                                                nperseg = self.nperseg,
+                                                noverlap = self.noverlap,
+                                                nfft = self.nfft)
+
+        times = ((times + self.buffer_start) * 1000).astype('datetime64[ms]')
+
+        # Keep whatever the next column will need
+        self.buffer = self.buffer[n_cols * self.hop:]
+        self.buffer_start += n_cols * self.hop / rate
+
+        return self._output((frequencies, times, 20 * numpy.log10(numpy.abs(power))))
+
+    def _output(self, spec):
+        # Band limited spectrograms only keep the displayed band, whichever
+        # way they were computed
+        if spectrogram_params()['band_limit']:
+            return crop(spec)
+        return spec
+
+
+def state_path(station):
+    state_dir = os.path.join(os.path.dirname(__file__), 'cache', 'streaming')
+    os.makedirs(state_dir, exist_ok = True)
+    return os.path.join(state_dir, f"{station}.pkl")
+
+
+@contextmanager
+def station_state(station, sampling_rate):
+    """
+    Load (or create) the streaming state for a station, and save it again
+    afterwards. Holds a lock on the state file so that two workers can't
+    update the same station at once.
+    """
+    path = state_path(station)
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        engine = None
+        try:
+            with open(path, 'rb') as state_file:
+                engine = pickle.load(state_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+        if engine is None or not engine.is_compatible(sampling_rate):
+            engine = StreamingSpectrogram(sampling_rate)
+
+        yield engine
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as state_file:
+            pickle.dump(engine, state_file)
+        os.replace(tmp_path, path)
+
+
+def process(station, trace):
+    """
+    Push a trace through the station's streaming state, returning the new
+    spectral columns, or None if the data is out of order and should be
+    processed on its own instead.
+    """
+    with station_state(station, trace.stats.sampling_rate) as engine:
+        return engine.push(trace)
@@ -0,0 +1,62 @@
+from obspy import Stream
+
+from .config import stations
+from .sources import get_source, span_coverage, stream_spans
+
+
+def fetch(requests):
+    # requests is a list of (network, station, location, channel, starttime, endtime)
+    # tuples. All requests are handed to the source at once so it can batch
+    # them however works best for it.
+    return get_source().get_waveforms_bulk(list(requests))
+
+
+def fetch_each(requests):
+    # Like fetch, but yields (index, stream) for each request as it completes
+    return get_source().iter_waveforms_bulk(list(requests))
+
+
+def prepare(stream):
+    """
+    Merge a raw stream into a single contiguous trace per channel, and
+    generate the matching sample times (as datetime64[ms]).
+
+    Returns (None, None) if there is no usable data.
+    """
+    if stream is None or not isinstance(stream, Stream) or stream.count() == 0:
+        return (None, None)
+
+    stream.merge(method = 1, fill_value = 'interpolate')
+    trace = stream[0]
+    if trace.stats.npts == 0:
+        return (None, None)
+
+    # Convert from counts to ground velocity
+    scale = stations.get(trace.stats.station, {}).get('SCALE')
+    if scale:
+        trace.data = trace.data / scale
+
+    times = trace.times()
+    DATA_START = trace.stats['starttime']
+    times = ((times + DATA_START.timestamp) * 1000).astype('datetime64[ms]')
+
+    return (stream, times)
+
+
+def load(NET, STA, LOC, CHAN, STARTTIME, ENDTIME):
+    stream = fetch([(NET, STA, LOC, CHAN, STARTTIME, ENDTIME)])[0]
+    return prepare(stream)
+
+
+def coverage(stream, starttime, endtime):
+    """
+    Fraction of starttime..endtime covered by the (unmerged) stream.
+    """
+    if stream is None:
+        return 0.0
+    return span_coverage(stream_spans(stream), starttime, endtime)
+
+
+def fetch_coverage(requests):
+    # Like fetch, but only asks the source how much of each range it has data for
+    return get_source().get_coverage_bulk(list(requests))
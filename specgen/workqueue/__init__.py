@@ -0,0 +1,133 @@
+"""
+Sharing the generation work between several generator hosts.
+
+The unit of work is a (station, window). Before fetching anything for a
+window, a generator claims it in a shared store, which gives it a lease that
+expires after QUEUE/LeaseSeconds. Once the window is done (or missed) the
+generator says so, and nobody else will take it on, so two hosts pointed at
+the same store never fetch or generate the same window twice. If a host dies
+part way through, its leases run out and the windows are retried by the next
+run on any host, along with the missed ones.
+
+Each unit is in one of three states:
+
+    leased   claimed by a generator, until the lease expires
+    done     generated; claimed again only to regenerate it with late data
+    missed   not generated; retried until it is LATEDATA/Hours old
+
+The store is picked by the QUEUE/Store option, like the waveform sources.
+Every generator also adds its throughput to the store after each run (see
+stats, or python -m specgen.workqueue).
+"""
+import os
+import socket
+
+from functools import lru_cache
+
+from ..config import config
+
+
+def unit_key(unit):
+    # (station, window end) identifies a unit; UTCDateTime can't be hashed
+    return (unit[0], unit[2].isoformat())
+
+
+class WorkQueue:
+    """
+    Units are (station, starttime, endtime) tuples, with UTCDateTime times.
+    """
+
+    def claim(self, owner, units, lease_seconds, redo_before = None):
+        # Lease whichever of units aren't done, missed, leased by someone else
+        # or leased by someone whose lease has expired. Units that are done are
+        # only claimed if they were finished before redo_before (a time.time()
+        # value). Returns the units that were claimed.
+        raise NotImplementedError
+
+    def complete(self, owner, generated, missed):
+        # Mark units leased by owner as done or missed
+        raise NotImplementedError
+
+    def release(self, owner, units):
+        # Give back units leased by owner without having tried them, leaving
+        # them as they were before being claimed
+        raise NotImplementedError
+
+    def add_missed(self, units):
+        # Queue units that nobody has tried yet to be retried
+        raise NotImplementedError
+
+    def retryable(self, since):
+        # Missed units, and units whose lease has expired, ending after since
+        raise NotImplementedError
+
+    def purge(self, before):
+        # Forget units ending before the given time, unless currently leased
+        raise NotImplementedError
+
+    def record_run(self, owner, generated, missed, seconds):
+        raise NotImplementedError
+
+    def stats(self):
+        # {'workers': [{owner, runs, windows, missed, seconds, windows_per_second,
+        # last_run}, ...], 'units': {state: count}}
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def worker_name():
+    # Who holds leases, and whose throughput is counted: the host name,
+    # unless QUEUE/WorkerName says otherwise
+    return config.get('QUEUE', 'workername', fallback = '') or socket.gethostname()
+
+
+def lease_seconds():
+    return config.getfloat('QUEUE', 'leaseseconds', fallback = 900)
+
+
+def shared_db_path():
+    # The database every generator host and the web app use (QUEUE/Path): the
+    # queue itself, and the availability records and other state that has to
+    # cover what all of the hosts generated. The cache DB unless set.
+    path = config.get('QUEUE', 'path', fallback = '') or 'cache/cache.db'
+    if not path.startswith('/'):
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), path)
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    return path
+
+
+def _sqlite_queue():
+    from .sqlite import SqliteWorkQueue
+    return SqliteWorkQueue(shared_db_path(),
+                           timeout = config.getfloat('QUEUE', 'timeout', fallback = 30))
+
+
+STORES = {
+    'sqlite': _sqlite_queue,
+}
+
+
+@lru_cache
+def get_queue(name = None):
+    if name is None:
+        name = config.get('QUEUE', 'store', fallback = 'sqlite')
+
+    try:
+        factory = STORES[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown work queue store '{name}'") from None
+
+    return factory()
+
+
+def main():
+    stats = get_queue().stats()
+    print("Units:", ", ".join(f"{state} {count}" for state, count in sorted(stats['units'].items()))
+          or "none")
+    for worker in stats['workers']:
+        print(f"{worker['owner']}: {worker['runs']} runs, {worker['windows']} windows,",
+              f"{worker['missed']} missed, {worker['windows_per_second']:.2f} windows/s,",
+              "last run", worker['last_run'])
@@ -0,0 +1,169 @@
+"""
+Work queue kept in an SQLite database.
+
+With several generator hosts, the database has to be on storage they all
+share (QUEUE/Path), on a filesystem with working POSIX locks. Every change is
+made in a single short write transaction, so hosts just wait their turn
+(up to QUEUE/Timeout seconds). Lease expiry uses the hosts' clocks, so they
+should be kept in sync.
+"""
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+from obspy import UTCDateTime
+
+from . import WorkQueue
+
+CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS work_units (
+    station TEXT,
+    endtime TEXT,
+    starttime TEXT,
+    state TEXT,
+    owner TEXT,
+    expires REAL,
+    finished REAL,
+    attempts INTEGER,
+    PRIMARY KEY (station, endtime)
+);
+CREATE TABLE IF NOT EXISTS work_stats (
+    owner TEXT PRIMARY KEY,
+    runs INTEGER,
+    windows INTEGER,
+    missed INTEGER,
+    seconds REAL,
+    last_run TEXT
+);
+"""
+
+
+class SqliteWorkQueue(WorkQueue):
+    def __init__(self, path, timeout = 30):
+        self.path = path
+        self.timeout = timeout
+        conn = sqlite3.connect(self.path, timeout = self.timeout)
+        try:
+            conn.executescript(CREATE_SQL)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock up front, so that claims can't interleave
+        conn = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def claim(self, owner, units, lease_seconds, redo_before = None):
+        now = time.time()
+        expires = now + lease_seconds
+        claimed = []
+        with self._transaction() as conn:
+            for unit in units:
+                station, start, end = unit
+                cur = conn.execute("""INSERT OR IGNORE INTO work_units
+                                      (station, endtime, starttime, state, owner, expires, attempts)
+                                      VALUES (?,?,?,'leased',?,?,1)""",
+                                   (station, end.isoformat(), start.isoformat(), owner, expires))
+                if cur.rowcount == 0:
+                    cur = conn.execute("""UPDATE work_units
+                                          SET state = 'leased', owner = ?, expires = ?,
+                                              attempts = attempts + 1
+                                          WHERE station = ? AND endtime = ?
+                                          AND (state = 'missed'
+                                               OR (state = 'leased' AND expires < ?)
+                                               OR (state = 'done' AND finished < ?))""",
+                                       (owner, expires, station, end.isoformat(), now,
+                                        -1 if redo_before is None else redo_before))
+                if cur.rowcount:
+                    claimed.append(unit)
+
+        return claimed
+
+    def complete(self, owner, generated, missed):
+        now = time.time()
+        with self._transaction() as conn:
+            for units, state, finished in ((generated, 'done', now), (missed, 'missed', None)):
+                conn.executemany("""UPDATE work_units
+                                    SET state = ?, expires = NULL, finished = ?
+                                    WHERE station = ? AND endtime = ?
+                                    AND state = 'leased' AND owner = ?""",
+                                 ((state, finished, station, end.isoformat(), owner)
+                                  for station, _, end in units))
+
+    def release(self, owner, units):
+        # Only done units have a finish time
+        with self._transaction() as conn:
+            conn.executemany("""UPDATE work_units
+                                SET state = CASE WHEN finished IS NULL THEN 'missed' ELSE 'done' END,
+                                    expires = NULL, attempts = attempts - 1
+                                WHERE station = ? AND endtime = ?
+                                AND state = 'leased' AND owner = ?""",
+                             ((station, end.isoformat(), owner) for station, _, end in units))
+
+    def add_missed(self, units):
+        with self._transaction() as conn:
+            conn.executemany("""INSERT OR IGNORE INTO work_units
+                                (station, endtime, starttime, state, attempts)
+                                VALUES (?,?,?,'missed',0)""",
+                             ((station, end.isoformat(), start.isoformat())
+                              for station, start, end in units))
+
+    def retryable(self, since):
+        conn = sqlite3.connect(self.path, timeout = self.timeout)
+        try:
+            cur = conn.execute("""SELECT station, starttime, endtime FROM work_units
+                                  WHERE endtime > ?
+                                  AND (state = 'missed' OR (state = 'leased' AND expires < ?))
+                                  ORDER BY endtime DESC""",
+                               (since.isoformat(), time.time()))
+            return [(station, UTCDateTime(start), UTCDateTime(end)) for station, start, end in cur]
+        finally:
+            conn.close()
+
+    def purge(self, before):
+        with self._transaction() as conn:
+            conn.execute("""DELETE FROM work_units WHERE endtime < ?
+                            AND NOT (state = 'leased' AND expires >= ?)""",
+                         (before.isoformat(), time.time()))
+
+    def record_run(self, owner, generated, missed, seconds):
+        with self._transaction() as conn:
+            conn.execute("""INSERT INTO work_stats (owner, runs, windows, missed, seconds, last_run)
+                            VALUES (?,1,?,?,?,?)
+                            ON CONFLICT (owner) DO UPDATE SET
+                                runs = runs + 1,
+                                windows = windows + excluded.windows,
+                                missed = missed + excluded.missed,
+                                seconds = seconds + excluded.seconds,
+                                last_run = excluded.last_run""",
+                         (owner, generated, missed, seconds, UTCDateTime().isoformat()))
+
+    def stats(self):
+        conn = sqlite3.connect(self.path, timeout = self.timeout)
+        try:
+            workers = [{
+                'owner': owner,
+                'runs': runs,
+                'windows': windows,
+                'missed': missed,
+                'seconds': seconds,
+                'windows_per_second': windows / seconds if seconds else 0.0,
+                'last_run': last_run,
+            } for owner, runs, windows, missed, seconds, last_run in conn.execute(
+                "SELECT owner, runs, windows, missed, seconds, last_run FROM work_stats ORDER BY owner")]
+            units = dict(conn.execute("SELECT state, COUNT(*) FROM work_units GROUP BY state"))
+        finally:
+            conn.close()
+
+        return {'workers': workers, 'units': units}
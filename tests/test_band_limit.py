@@ -0,0 +1,93 @@
+"""
+The band limited spectrogram (SPECTROGRAM/BandLimit) against the full rate
+one it stands in for, within MinFreq..MaxFreq.
+
+The two can't agree cell for cell: a cell dominated by window sidelobe
+leakage (from a strong tone, or from energy above the decimated Nyquist,
+which only the full rate path sees) or sitting in a noise null differs by
+however much the leakage differs. So the tolerances are on what gets looked
+at: the peaks, the mean level at each frequency, and the bulk of the cells.
+"""
+import numpy
+import pytest
+
+from obspy import Trace, UTCDateTime
+
+from specgen import graphing
+from specgen.config import config
+from specgen.spectra import crop, spectrogram_params
+
+MIN_FREQ = 0
+MAX_FREQ = 10
+
+# dB, as computed (20 * log10 of the power density)
+PEAK_TOLERANCE = .1
+MEAN_TOLERANCE = 1
+MEDIAN_TOLERANCE = 1
+P95_TOLERANCE = 3
+
+
+@pytest.fixture
+def spectrogram_config():
+    settings = {
+        'windowtype': 'hamming',
+        'windowsize': '1024',
+        'overlap': '924',
+        'nfft': '1024',
+        'minfreq': str(MIN_FREQ),
+        'maxfreq': str(MAX_FREQ),
+        'streaming': 'false',
+    }
+    if not config.has_section('SPECTROGRAM'):
+        config.add_section('SPECTROGRAM')
+    saved = dict(config['SPECTROGRAM'])
+    config['SPECTROGRAM'].update(settings)
+    yield
+    config.remove_section('SPECTROGRAM')
+    config.add_section('SPECTROGRAM')
+    config['SPECTROGRAM'].update(saved)
+
+
+def synthetic_trace(rate):
+    # Ten minutes of noise, a strong in band tone, and an out of band one
+    rng = numpy.random.default_rng(0)
+    times = numpy.arange(int(600 * rate)) / rate
+    data = (rng.normal(0, 1e-6, len(times)) + 1e-5 * numpy.sin(2 * numpy.pi * 3 * times)
+            + 2e-6 * numpy.sin(2 * numpy.pi * .3 * rate * times))
+    return Trace(data = data, header = {'sampling_rate': rate,
+                                        'starttime': UTCDateTime(2023, 1, 1)})
+
+
+def compute(trace, band_limit):
+    config.set('SPECTROGRAM', 'bandlimit', str(band_limit).lower())
+    return graphing.compute_spectrogram(trace)
+
+
+@pytest.mark.parametrize('rate', [50.0, 100.0, 200.0])
+def test_band_limit_matches_full(spectrogram_config, rate):
+    trace = synthetic_trace(rate)
+    config.set('SPECTROGRAM', 'bandlimit', 'true')
+    assert graphing.band_limit_factor(rate, spectrogram_params()) > 1
+
+    full_freqs, full_times, full = crop(compute(trace, False))
+    band_freqs, band_times, band = compute(trace, True)
+
+    numpy.testing.assert_allclose(band_freqs, full_freqs)
+    numpy.testing.assert_array_equal(band_times, full_times)
+
+    in_band = (full_freqs >= MIN_FREQ) & (full_freqs <= MAX_FREQ)
+    full = full[in_band]
+    band = band[in_band]
+    diff = numpy.abs(band - full)
+
+    peak = full >= full.max() - 6
+    assert diff[peak].max() < PEAK_TOLERANCE
+
+    # Leaving out the lowest two bins, which removing each segment's mean
+    # makes sensitive to energy at all frequencies
+    def mean_level(power):
+        return 20 * numpy.log10(numpy.mean(10 ** (power / 20), axis = 1))
+    assert numpy.abs(mean_level(band) - mean_level(full))[2:].max() < MEAN_TOLERANCE
+
+    assert numpy.median(diff) < MEDIAN_TOLERANCE
+    assert numpy.percentile(diff, 95) < P95_TOLERANCE
@@ -0,0 +1,68 @@
+from datetime import datetime
+from io import BytesIO
+
+import numpy
+import pytest
+
+from PIL import Image
+
+from specgen import raster
+from specgen.colormap import spectro_palette
+from specgen.config import config
+from specgen.specweb import mosaic
+
+
+@pytest.fixture
+def thumbnail_format():
+    if not config.has_section('RENDER'):
+        config.add_section('RENDER')
+    saved = config.get('RENDER', 'thumbnailformat', fallback = None)
+
+    def set_format(image_format):
+        config.set('RENDER', 'thumbnailformat', image_format)
+
+    yield set_format
+
+    if saved is None:
+        config.remove_option('RENDER', 'thumbnailformat')
+    else:
+        config.set('RENDER', 'thumbnailformat', saved)
+
+
+def write_tile(path):
+    # A tile in the last palette color (black), so it can't pass for white
+    path.parent.mkdir(parents = True, exist_ok = True)
+    image = numpy.full((raster.THUMB_HEIGHT, raster.THUMB_WIDTH),
+                       len(spectro_palette()) - 1, dtype = numpy.uint8)
+    path.write_bytes(raster.encode_image(image))
+
+
+def test_compose_webp(tmp_path, thumbnail_format):
+    thumbnail_format('webp')
+    path = tmp_path / 'small_20230101T001000.webp'
+    write_tile(path)
+
+    sheet = mosaic.compose(['SPCP'], 1, [(0, 0, None, None, [str(path)])])
+    pixels = numpy.asarray(Image.open(BytesIO(sheet)).convert('RGB'))
+
+    assert pixels.shape == (raster.THUMB_HEIGHT, raster.THUMB_WIDTH, 3)
+    assert (pixels != 255).any()
+
+
+def test_tile_file_falls_back_to_other_format(tmp_path, monkeypatch, thumbnail_format):
+    monkeypatch.setattr(mosaic, 'plots_dir', lambda: str(tmp_path))
+    start = datetime(2023, 1, 1, 0, 0)
+    end = datetime(2023, 1, 1, 0, 10)
+
+    # Made while thumbnails were still PNGs
+    thumbnail_format('png')
+    png_path = tmp_path / 'SPCP' / '2023' / '1' / '1' / 'small_20230101T001000.png'
+    write_tile(png_path)
+
+    thumbnail_format('webp')
+    assert mosaic.tile_file('SPCP', 'small_', start, end) == str(png_path)
+
+    # New images take precedence once they exist
+    webp_path = png_path.with_suffix('.webp')
+    write_tile(webp_path)
+    assert mosaic.tile_file('SPCP', 'small_', start, end) == str(webp_path)
@@ -0,0 +1,51 @@
+import numpy
+import pytest
+
+from obspy import Trace, UTCDateTime
+
+from specgen import graphing
+from specgen.config import config
+from specgen.streaming import StreamingSpectrogram
+
+
+@pytest.fixture(params = [False, True], ids = ['full', 'band_limit'])
+def streaming_config(request):
+    saved = {section: dict(config[section]) for section in ('SPECTROGRAM', 'FILTER')
+             if config.has_section(section)}
+    for section in ('SPECTROGRAM', 'FILTER'):
+        if not config.has_section(section):
+            config.add_section(section)
+
+    config['SPECTROGRAM'].update({'windowtype': 'hamming', 'windowsize': '1024',
+                                  'overlap': '924', 'nfft': '1024', 'minfreq': '0',
+                                  'maxfreq': '10', 'streaming': 'true',
+                                  'bandlimit': str(request.param).lower()})
+    config['FILTER'].update({'enabled': 'true', 'lowcut': '.5', 'highcut': '15',
+                             'order': '2'})
+    yield request.param
+
+    for section in ('SPECTROGRAM', 'FILTER'):
+        config.remove_section(section)
+        if section in saved:
+            config.add_section(section)
+            config[section].update(saved[section])
+
+
+def test_fallback_matches_fresh_stream(streaming_config):
+    # Windows that can't be streamed are stored under the same parameters,
+    # so they have to be computed the same way.
+    rng = numpy.random.default_rng(0)
+    trace = Trace(data = rng.normal(0, 1e-6, 60000),
+                  header = {'sampling_rate': 100.0, 'starttime': UTCDateTime(2023, 1, 1)})
+
+    frequencies, times, power = StreamingSpectrogram(100.0).push(trace)
+    full_frequencies, full_times, full_power = graphing.compute_spectrogram(trace)
+
+    numpy.testing.assert_allclose(frequencies, full_frequencies)
+    assert power.shape == full_power.shape
+    if streaming_config:
+        # Cropped to the displayed band; the values differ as the full path
+        # is decimated (see test_band_limit)
+        assert frequencies[-1] < 11
+    else:
+        numpy.testing.assert_allclose(power, full_power)
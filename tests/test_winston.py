@@ -0,0 +1,96 @@
+import struct
+
+import numpy
+import pytest
+
+from obspy import UTCDateTime
+
+from specgen.sources.fakewinston import FakeWinstonServer, synthetic_data
+from specgen.sources.winston import (TRACEBUF_HEADER, TRACEBUF_HEADER_SIZE, WinstonSource,
+                                     parse_tracebufs, tracebuf_spans)
+
+
+def tracebuf(start, data, rate = 50.0, sta = 'SPCP', datatype = 'i4'):
+    endian = '>' if datatype[0] in 'st' else '<'
+    header = struct.pack(endian + TRACEBUF_HEADER, 0, len(data), start,
+                         start + (len(data) - 1) / rate, rate, sta.encode(), b'AV',
+                         b'BHZ', b'--', b'20', datatype.encode(), b'\x00\x00', b'\x00\x00')
+    return header + numpy.asarray(data, dtype = f"{endian}i4").tobytes()
+
+
+def test_header_size():
+    assert TRACEBUF_HEADER_SIZE == 64
+
+
+def test_parse_joins_contiguous_packets():
+    payload = (tracebuf(1000.0, range(50)) + tracebuf(1001.0, range(50, 100))
+               + tracebuf(1005.0, range(10)))
+    stream = parse_tracebufs(payload)
+
+    assert len(stream) == 2
+    first, second = stream
+    assert first.stats.station == 'SPCP'
+    assert first.stats.network == 'AV'
+    assert first.stats.channel == 'BHZ'
+    assert first.stats.location == ''
+    assert first.stats.sampling_rate == 50.0
+    assert first.stats.starttime == UTCDateTime(1000.0)
+    numpy.testing.assert_array_equal(first.data, numpy.arange(100))
+    assert second.stats.starttime == UTCDateTime(1005.0)
+    numpy.testing.assert_array_equal(second.data, numpy.arange(10))
+
+
+def test_parse_big_endian():
+    stream = parse_tracebufs(tracebuf(1000.0, [1, -2, 300000], datatype = 's4'))
+    numpy.testing.assert_array_equal(stream[0].data, [1, -2, 300000])
+    assert stream[0].data.dtype.isnative
+
+
+def test_tracebuf_spans():
+    payload = (tracebuf(1000.0, range(50)) + tracebuf(1001.0, range(50), datatype = 's4')
+               + tracebuf(1005.0, range(10)))
+    assert tracebuf_spans(payload) == pytest.approx([(1000.0, 1001.0), (1001.0, 1002.0),
+                                                     (1005.0, 1005.2)])
+
+
+def test_parse_empty_payload():
+    assert len(parse_tracebufs(b'')) == 0
+    assert tracebuf_spans(b'') == []
+
+
+@pytest.fixture
+def server():
+    with FakeWinstonServer(missing = ['GONE']) as server:
+        yield server
+
+
+def test_bulk_fetch(server):
+    host, port = server.address
+    source = WinstonSource(host, port, pool_size = 2, timeout = 5)
+    start = UTCDateTime(2023, 1, 1)
+    stations = ['SPCP', 'SPBG', 'GONE', 'SPNN', 'SPCG']
+    bulk = [('AV', sta, '--', 'BHZ', start, start + 60) for sta in stations]
+
+    try:
+        streams = source.get_waveforms_bulk(bulk)
+        # Twice, so the pooled connections get reused
+        again = source.get_waveforms_bulk(bulk)
+        assert sorted(idx for idx, _ in source.iter_waveforms_bulk(bulk)) == list(range(len(bulk)))
+        assert source._pool.qsize() <= 2
+    finally:
+        source.close()
+
+    for sta, stream, stream_again in zip(stations, streams, again):
+        if sta == 'GONE':
+            assert len(stream) == 0
+            continue
+
+        assert len(stream) == 1
+        trace = stream[0]
+        assert trace.stats.station == sta
+        assert trace.stats.starttime == start
+        assert trace.stats.endtime == start + 60
+        expected = synthetic_data(sta, 'BHZ', start.timestamp, trace.stats.npts,
+                                  server.rate)
+        numpy.testing.assert_array_equal(trace.data, expected)
+        numpy.testing.assert_array_equal(stream_again[0].data, trace.data)